@@ -5,25 +5,49 @@ Created on Sun Nov 21 12:08:23 2021
 @author: dmosc
 """
 
+import logging
+import os
+import time
+import numpy as np
 import pandas as pd
-import json
-import urllib.request
-from functools import reduce
+import urllib3
 import plotly.graph_objects as go
 import dash
 import dash_html_components as html
 import dash_core_components as dcc
 import dash_bootstrap_components as dbc
-from dash.dependencies import Output, Input
+from dash.dependencies import Output, Input, State
+import store
+import fetch
+import genmix
+import seasonal
+import cache
+import refresh
+import intensity
+import metrics
+import snapshot
+import rollups
+import dataapi
 
 app = dash.Dash(__name__, external_stylesheets = [dbc.themes.BOOTSTRAP])
 
 server = app.server
+metrics.init_app(server)
+
+log = logging.getLogger(__name__)
+
+#Each worker starts its refresher when it serves its first request, so a gunicorn master that preloaded the app never runs one.
+server.before_request(refresh.start)
+
+snapshot.load()
 
 colors = ['#636EFA', '#EF553B', '#00CC96', '#AB63FA', '#FFA15A', '#19D3F3', '#FF6692', '#B6E880', '#FF97FF', '#FECB52']
 
 states = ["AL", "AK", "AZ", "AR", "CA", "CO", "CT", "DE", "DC", "FL", "GA", "HI", "ID", "IL", "IN", "IA", "KS", "KY", "LA", "ME", "MD", "MA", "MI", "MN", "MS", "MO", "MT", "NE", "NV", "NH", "NJ", "NM", "NY", "NC", "ND", "OH", "OK", "OR", "PA", "RI", "SC", "SD", "TN", "TX", "UT", "VT", "VA", "WA", "WV", "WI", "WY"]
 
+#States and the groups rolled up from them (see rollups.py), in the order the dropdowns list them.
+places = states + list(rollups.GROUPS)
+
 fuel_types = {"COW": "Coal",
 "PEL": "Petroleum liquids",
 "PC": "Petroleum coke",
@@ -47,143 +71,289 @@ fuel_types = {"COW": "Coal",
 
 years = list(range(2001, 2022))
 
-#Store data rec'd from API in pulled_data for future use
-pulled_data = {}
-for state in states:
-    pulled_data[state] = {}
+#With EIA_RANGE_PATCH on, the Con/Prod plots hold a state's whole history and a change to the year range alone is
+#answered with a Patch that moves the axis window, rather than a new figure.
+RANGE_PATCH = os.environ.get('EIA_RANGE_PATCH', '1') not in ('', '0')
 
-def get_retail_sales(state):
+#With EIA_BACKGROUND_LOADS on, callbacks never wait on EIA. Series that aren't stored yet are loaded by fetch.background,
+#the plot is drawn from what is stored, and a dcc.Interval redraws it every POLL_MS until everything has landed.
+BACKGROUND_LOADS = os.environ.get('EIA_BACKGROUND_LOADS', '1') not in ('', '0')
+POLL_MS = 500
 
-    if "retail_sales" in pulled_data[state].keys():
-        return pulled_data[state]["retail_sales"]
-    else:            
-        api_call = "https://api.eia.gov/series/?api_key=c0b197bcf4610007c7e977fccc486830&series_id=ELEC.SALES." + state + "-ALL.M"
-        with urllib.request.urlopen(api_call) as url:
-            data = json.loads(url.read().decode())
-        
-        df = pd.DataFrame(
-            data['series'][0]['data'],
-            columns = ['Date', "energy"])
+#Series rec'd from the API are kept in the on-disk store (see store.py), shared by all workers, and read from its
+#memory-mapped snapshot (see snapshot.py) while that is current.
+#Compact frames built from them are kept in cache.frames, keyed by (state, kind), for future use within this worker.
+
+def get_series_batch(series_ids):
+    #Returns {series_id: (units, df)} with df columns Year, Month, Value, leaving out ids EIA has no series for.
+    #Ids not yet in the store are fetched from the API concurrently, and callers missing the same id at
+    #the same time share a single fetch.
+    res = {}
+    missing = []
+    for series_id in series_ids:
+        stored = snapshot.read_series(series_id) or store.read_series(series_id)
+        if stored is None:
+            missing.append(series_id)
+        else:
+            res[series_id] = stored
+
+    if missing:
+        loaded = fetch.flights.do_many(missing, load_series_batch)
+        res.update({series_id: loaded[series_id] for series_id in missing if loaded[series_id] is not None})
+    return res
+
+def load_series_batch(series_ids):
+    #Pulls series from the API into the store. Returns {series_id: (units, df)}, with None for ids EIA has no series for.
+    res = {}
+    to_fetch = []
+    for series_id in series_ids:
+        #Another thread or worker may have finished this fetch since the caller checked the store.
+        stored = store.read_series(series_id)
+        if stored is None:
+            to_fetch.append(series_id)
+        else:
+            res[series_id] = stored
+    #Rollups aren't EIA series; they are summed from their members once those are loaded.
+    to_sum = [series_id for series_id in to_fetch if rollups.is_rollup(series_id)]
+    to_fetch = [series_id for series_id in to_fetch if not rollups.is_rollup(series_id)]
+
+    #Each series is stored as it arrives, so callbacks polling the store draw it while the rest are still loading.
+    #A series EIA fails on doesn't cost the batch the series it did send: those are stored before the error is raised.
+    error = None
+    urls = {fetch.api_url + series_id: series_id for series_id in to_fetch}
+    for url, loaded in fetch.fetch_completed(list(urls), fetch.fetch_series_or_error):
+        series_id = urls[url]
+        if isinstance(loaded, Exception):
+            error = error or loaded
+            continue
+        if loaded is not None:
+            store.write_series(series_id, *loaded)
+        res[series_id] = loaded
+    if error is not None:
+        raise error
+    if to_sum:
+        res.update(load_rollups(to_sum))
+    return res
+
+def load_rollups(series_ids):
+    #Stores the rollup series_ids, first loading any member series that aren't stored. Returns {series_id: (units, df)},
+    #with None for rollups that have no period every member reports.
+    members = list(dict.fromkeys(member for series_id in series_ids for member in rollups.coverage_ids(series_id)))
+    found = get_series_batch(members)
+    for member in members:
+        #A fuel EIA has no series for is stored as zeros, as it is for the state, so no worker asks EIA for it again.
+        if member not in found and rollups.is_fuel_gen(member):
+            store_zero_net_gen(member, get_series(net_gen_id(rollups.state_of(member), "ALL")))
+    with metrics.span('rollup'):
+        loaded = rollups.materialize(series_ids)
+    return {series_id: loaded.get(series_id) for series_id in series_ids}
+
+def get_series(series_id):
+    #Raises KeyError if EIA has no such series.
+    return get_series_batch([series_id])[series_id]
+
+def retail_sales_id(state):
+    return "ELEC.SALES." + state + "-ALL.M"
+
+def get_retail_sales(state):
+    #Columns Year (int16), Month (int8) and TWh (float32). Axis labels are made when plotting.
+    df = cache.frames.get((state, "retail_sales"))
+    if df is None:
+        units, df = get_series(retail_sales_id(state))
         
-        df['Year'] = df.Date.str.slice(0,4).astype(int)
-        df['Month'] = df.Date.str.slice(4,6).astype(int)
-        df['TWh'] = df.energy / 1000
-        df['xaxis_labels'] = df.Date.str.slice(4,6) + "/" + df.Date.str.slice(0,4)
-        df = df.loc[:, ['Year', 'Month', 'TWh', 'xaxis_labels']]
-    
-        df_Min = pd.DataFrame(df.groupby(['Month'])['TWh'].min()).rename(columns = {'TWh':'Min'})
-        df_Q1 = pd.DataFrame(df.groupby(['Month'])['TWh'].quantile([0.25])).rename(columns = {'TWh':'Q1'})
-        df_Q3 = pd.DataFrame(df.groupby(['Month'])['TWh'].quantile([0.75])).rename(columns = {'TWh':'Q3'})
-        df_Max = pd.DataFrame(df.groupby(['Month'])['TWh'].max()).rename(columns = {'TWh':'Max'})
-    
-        df_list = [df, df_Min, df_Q1, df_Q3, df_Max]
-    
-        res = reduce(lambda left, right: pd.merge(left, right, on = ['Month'], how = 'outer'), df_list)
+        df = pd.DataFrame({
+            'Year': df.Year.astype('int16'),
+            'Month': df.Month.astype('int8'),
+            'TWh': (df.Value / 1000).astype('float32')})
         
-        pulled_data[state]["retail_sales"] = res
-        return res
+        cache.frames.put((state, "retail_sales"), df)
+    return df
+
+def get_seasonal_bands(state):
+    #Min, Q1, Q3 and Max retail sales by Month, read from the seasonal index (see seasonal.py).
+    bands = cache.frames.get((state, "bands"))
+    if bands is None:
+        bands = store.read_bands(state)
+        if bands is None:
+            #Not indexed yet, e.g. the store was filled before the index existed.
+            df = get_retail_sales(state)
+            update_seasonal_index(df.assign(state = state))
+            bands = store.read_bands(state)
+
+        cache.frames.put((state, "bands"), bands)
+    return bands
+
+def build_seasonal_index(states = states):
+    #One groupby pass over every state's retail sales. Fetches any series not yet in the store.
+    found = get_series_batch([retail_sales_id(state) for state in states])
+    sales = pd.concat([
+        found[retail_sales_id(state)][1].assign(state = state, TWh = lambda df: df.Value / 1000)
+        for state in states])
+    with metrics.span('seasonal_index'):
+        store.write_bands(seasonal.compute_bands(sales))
+    for state in states:
+        cache.frames.pop((state, "bands"))
+
+def update_seasonal_index(new_rows):
+    #new_rows has columns state, Year, Month: observations just added to the store.
+    #Only the (state, month) bands they fall in are recomputed, from the full history in the store.
+    sales = pd.concat([
+        get_series(retail_sales_id(state))[1].assign(state = state, TWh = lambda df: df.Value / 1000)
+        for state in new_rows.state.unique()])
+    with metrics.span('seasonal_index'):
+        store.write_bands(seasonal.update_bands(sales, new_rows))
+    for state in new_rows.state.unique():
+        cache.frames.pop((state, "bands"))
 
 def get_net_gen(state, fuel):
-    if fuel in pulled_data[state].keys():
-        return pulled_data[state][fuel]
-    else:
-        try:
-            api_call = "https://api.eia.gov/series/?api_key=c0b197bcf4610007c7e977fccc486830&series_id=ELEC.GEN." + fuel + "-" + state + "-99.M"
-            with urllib.request.urlopen(api_call) as url:
-                data = json.loads(url.read().decode())
-            df = pd.DataFrame(
-                data['series'][0]['data'],
-                columns = ['Date', fuel])
-        
-        except KeyError:
-            api_call = "https://api.eia.gov/series/?api_key=c0b197bcf4610007c7e977fccc486830&series_id=ELEC.GEN.ALL-" + state + "-99.M"
-            with urllib.request.urlopen(api_call) as url:
-                data = json.loads(url.read().decode())
-            df = pd.DataFrame(
-                data['series'][0]['data'],
-                columns = ['Date', fuel])
-            df[fuel] = 0
-    
-        df['Year'] = df.Date.str.slice(0,4).astype(int)
-        df['Month'] = df.Date.str.slice(4,6).astype(int)
-        df = df.loc[:, ['Year', 'Month', fuel]]
-        pulled_data[state][fuel] = df
-        return df
+    return get_net_gen_batch(state, [fuel])[fuel]
 
-def get_net_gens(state, fuels, start, end):
-    df_list = []
-###
-    if 'select_all' in fuels:
-        fuels = list(fuel_types)
-###
+def net_gen_id(state, fuel):
+    return "ELEC.GEN." + fuel + "-" + state + "-99.M"
 
-    fuels.append("ALL")
+def store_zero_net_gen(series_id, all_gen):
+    #For a fuel EIA has no series for, i.e. no generation from it in the state: a zero series on the dates of
+    #the state's ALL series (units, df), stored under the fuel's own id so no worker asks EIA for it again.
+    units, df = all_gen
+    df = df.assign(Value = 0.0)
+    store.write_series(series_id, units, df, zero_filled = True)
+    return units, df
 
-    
+def get_net_gen_batch(state, fuels):
+    #ALL always rides along in the batch, since it is the fallback for fuels EIA has no series for.
+    series_ids = {fuel: net_gen_id(state, fuel) for fuel in fuels}
+    all_id = net_gen_id(state, "ALL")
+    found = get_series_batch(list(dict.fromkeys(list(series_ids.values()) + [all_id])))
+
+    res = {}
     for fuel in fuels:
-        tmp = get_net_gen(state, fuel)
-        tmp = tmp[(tmp.Year >= start) & (tmp.Year <= end)]
-        df_list.append(tmp)
-    
-    merged_df = reduce(lambda left, right: pd.merge(left, right, on = ['Year', 'Month'], how = 'outer'), df_list)
-    fuels_by_variance = list(merged_df.iloc[:, 2:].var().sort_values().index)
-    sorted_df = merged_df[fuels_by_variance]
-
-    sorted_asfractions_df = sorted_df.drop(columns = "ALL").div(sorted_df.ALL, axis = 0)
-    cumulative_df = pd.DataFrame({
-        'Year': merged_df.Year,
-        'Month': merged_df.Month})
-    for col in sorted_asfractions_df.columns:
-        cumulative_df[col] = sorted_asfractions_df.loc[:, :col].sum(axis = 1)
-    
-    cumulative_df['xaxis_labels'] = cumulative_df.Month.astype(str) + "/" + cumulative_df.Year.astype(str)
-    res = cumulative_df.sort_values(['Year', 'Month']).reset_index(drop = True)
-        
+        if series_ids[fuel] in found:
+            units, df = found[series_ids[fuel]]
+        else:
+            units, df = store_zero_net_gen(series_ids[fuel], found[all_id])
+
+        df = df.rename(columns = {'Value': fuel})
+        res[fuel] = df.loc[:, ['Year', 'Month', fuel]]
     return res
 
+def get_gen_mix(state, fuels):
+    #The state's generation matrix, extended with any of fuels it doesn't hold yet.
+    gen_mix = cache.frames.get((state, "gen_mix"))
+    missing = [fuel for fuel in fuels if gen_mix is None or fuel not in gen_mix.columns]
+    if missing:
+        net_gens = get_net_gen_batch(state, missing)
+        with metrics.span('gen_mix_build'):
+            gen_mix = genmix.GenerationMix.from_frames(net_gens) if gen_mix is None else gen_mix.extend(net_gens)
+        cache.frames.put((state, "gen_mix"), gen_mix)
+    return gen_mix
+
+def selected_fuels(fuels):
+    #The fuel codes a value of the fuels dropdown stands for, in a canonical order.
+    if 'select_all' in fuels:
+        return tuple(fuel_types)
+    return tuple(sorted(set(fuels)))
+
+def get_net_gens(state, fuels, start, end):
+    #Cumulative fractions over every month held for the state, stacked in order of the fuels' variance from start to end.
+    fuels = list(selected_fuels(fuels)) + ["ALL"]
+
+    gen_mix = get_gen_mix(state, fuels)
+    with metrics.span('gen_mix'):
+        return gen_mix.cumulative(fuels, order = gen_mix.order(fuels, start, end))
+
+def get_net_gens_order(state, fuels, start, end):
+    fuels = list(selected_fuels(fuels)) + ["ALL"]
+    return get_gen_mix(state, fuels).order(fuels, start, end)
+
+def get_net_gens_months(state, fuels):
+    #Year and Month of the rows get_net_gens returns.
+    fuels = list(selected_fuels(fuels)) + ["ALL"]
+    periods = get_gen_mix(state, fuels).months(fuels)
+    return pd.DataFrame({'Year': periods // 100, 'Month': periods % 100})
+
+def get_intensity_panel(selected):
+    #The (state, Year) intensity panel (see intensity.py), holding at least the selected states. When one is missing,
+    #its series are fetched and the panel is rebuilt in one pass over every state in the store. With nothing selected
+    #and nothing cached, it is built from what is stored, which may be no state at all.
+    panel = cache.frames.get((None, "intensity_panel"))
+    missing = list(selected) if panel is None else [state for state in selected if state not in panel.index.unique('state')]
+    if panel is None or missing:
+        if missing:
+            get_series_batch(intensity.series_ids(missing))
+        long = store.read_long(intensity.series_ids(places))
+        with metrics.span('intensity_panel'):
+            panel = intensity.build_panel(long)
+        cache.frames.put((None, "intensity_panel"), panel)
+    return panel
+
 def get_intensity(state):
-    if 'intensity' in pulled_data[state].keys():
-        return pulled_data[state]['intensity']
-    else:
-        api_call_population = "https://api.eia.gov/series/?api_key=c0b197bcf4610007c7e977fccc486830&series_id=SEDS.TPOPP." + state + ".A"
-        api_call_real_gdp = "https://api.eia.gov/series/?api_key=c0b197bcf4610007c7e977fccc486830&series_id=SEDS.GDPRX." + state + ".A"
-        api_call_total_consumption = "https://api.eia.gov/series/?api_key=c0b197bcf4610007c7e977fccc486830&series_id=SEDS.TETCB." + state + ".A"
-    
-        with urllib.request.urlopen(api_call_population) as url:
-            data = json.loads(url.read().decode())
-        units = data['series'][0]['units']
-
-        df_pop = pd.DataFrame(
-            data['series'][0]['data'],
-            columns = ['Year', units])
-            
-        with urllib.request.urlopen(api_call_real_gdp) as url:
-            data = json.loads(url.read().decode())
-        units = data['series'][0]['units']
-        
-        df_real_gdp = pd.DataFrame(
-            data['series'][0]['data'],
-            columns = ['Year', units])
-        
-        with urllib.request.urlopen(api_call_total_consumption) as url:
-            data = json.loads(url.read().decode())
-        units = data['series'][0]['units']
-        
-        df_total_consumption = pd.DataFrame(
-            data['series'][0]['data'],
-            columns = ['Year', units])
-    
-        df_list = [df_pop, df_real_gdp, df_total_consumption]
-    
-        df_merged = reduce(lambda left,right: pd.merge(left, right, on = ['Year'], how = 'outer'), df_list)
-        
-        df_merged['perCap'] = df_merged.iloc[:,3] / df_merged.iloc[:,1]
-        df_merged['perUSD'] = df_merged.iloc[:,3] / df_merged.iloc[:,2]
-        
-        df_merged['Year'] = df_merged['Year'].astype(int)
-        df_merged = df_merged.sort_values(by = 'Year')
-        pulled_data[state]['intensity'] = df_merged
-        return df_merged
+    #One state's rows of the panel, indexed by Year.
+    return get_intensity_panel([state]).loc[state]
+
+def series_key(series_id):
+    #(state, kind, code) for a series id, where (state, kind) is the cache.frames entry the series feeds.
+    parts = series_id.split('.')
+    if parts[0] == 'SEDS':
+        return None, 'intensity_panel', series_id
+    if parts[1] == 'SALES':
+        return parts[2].split('-')[0], 'retail_sales', None
+    fuel, state = parts[2].split('-')[:2]
+    return state, 'gen_mix', fuel
+
+@refresh.on_new_rows
+def apply_new_rows(new_rows, version):
+    #Folds observations a refresh just appended to the store into the derived products: the seasonal bands
+    #of states whose sales moved, and this worker's generation matrices and intensity panel.
+    #A cached entry is updated in place only if it was current as of version, before the refresh wrote anything.
+    by_entry = {}
+    for series_id, df in new_rows.items():
+        state, kind, code = series_key(series_id)
+        by_entry.setdefault((state, kind), {})[code] = df
+
+    retail = []
+    for (state, kind), rows in by_entry.items():
+        cached, cached_version = cache.frames.peek((state, kind))
+        if kind == 'retail_sales':
+            cache.frames.pop((state, kind))
+            retail.append(rows[None].assign(state = state))
+        elif cached is None:
+            continue
+        elif cached_version != version:
+            cache.frames.pop((state, kind))
+        elif kind == 'gen_mix':
+            cache.frames.put((state, kind), cached.extend({
+                fuel: df.rename(columns = {'Value': fuel}) for fuel, df in rows.items() if fuel in cached.columns}))
+        else:
+            long = pd.concat([df.assign(series_id = series_id) for series_id, df in rows.items()])
+            with metrics.span('intensity_panel'):
+                cache.frames.put((state, kind), intensity.update_panel(cached, long))
+
+    if retail:
+        update_seasonal_index(pd.concat(retail))
+
+def all_series_ids(states):
+    #Every series the app reads for states.
+    res = []
+    for state in states:
+        res += [net_gen_id(state, fuel) for fuel in list(fuel_types) + ["ALL"]]
+        res.append(retail_sales_id(state))
+    return res + intensity.series_ids(states)
+
+def preload():
+    #Run by a gunicorn master that preloads the app, before it forks (see gunicorn.conf.py). Maps a current snapshot
+    #of the store and builds the frames of every state whose series are all stored, so each worker starts with them.
+    if snapshot.current is None or snapshot.current.data_version != store.data_version():
+        snapshot.write()
+        snapshot.load()
+    stored = store.last_periods(all_series_ids(places))
+    ready = [state for state in places if all(series_id in stored for series_id in all_series_ids([state]))]
+    for state in ready:
+        get_retail_sales(state)
+        get_seasonal_bands(state)
+        get_gen_mix(state, list(fuel_types) + ["ALL"])
+    if ready:
+        get_intensity_panel(ready)
+    return ready
 
 app.layout = dbc.Tabs([
     dbc.Tab([
@@ -201,8 +371,8 @@ app.layout = dbc.Tabs([
                 dbc.Col(html.Div([
                     html.B('Select a state from the dropdown menu below.'),
                     dcc.Dropdown(id = 'state_dropdown_1',
-                        options = [{'label': state, 'value': state}
-                            for state in states],
+                        options = [{'label': rollups.label(state), 'value': state}
+                            for state in places],
                     value = 'NY',),
                 ])),
                 dbc.Col(html.Div([
@@ -254,8 +424,14 @@ app.layout = dbc.Tabs([
         html.P(),
         ]),
         html.Div([
+            html.I(id = 'consumption_status'),
             dcc.Graph(id = 'consumption',),
+            html.I(id = 'generation_status'),
             dcc.Graph(id = 'generation',),
+            dcc.Store(id = 'consumption_view'),
+            dcc.Store(id = 'generation_view'),
+            dcc.Interval(id = 'consumption_poll', interval = POLL_MS, disabled = True),
+            dcc.Interval(id = 'generation_poll', interval = POLL_MS, disabled = True),
 
             html.P(),
             ('Some questions that could be answered with these plots include:'),
@@ -286,8 +462,8 @@ app.layout = dbc.Tabs([
                     html.Div([
                         html.B('Select states from the dropdown menu below.'),
                         dcc.Dropdown(id = 'state_multidropdown_2',
-                            options = [{'label': state, 'value': state}
-                                for state in states],
+                            options = [{'label': rollups.label(state), 'value': state}
+                                for state in places],
                             value = ['NY'],
                             multi = True),
                     ])
@@ -312,7 +488,10 @@ app.layout = dbc.Tabs([
                 ),
             ]),
         ]),
+        html.I(id = 'intensities_status'),
         dcc.Graph(id = 'intensities', style = {'width': '90vh'}),
+        dcc.Store(id = 'intensities_view'),
+        dcc.Interval(id = 'intensities_poll', interval = POLL_MS, disabled = True),
         ('Some questions that could be answered with this plot include:'),
         html.P(),
         html.I('How does energy intensity change with a state\'s GDP?'),
@@ -349,71 +528,193 @@ app.layout = dbc.Tabs([
     ], style = {'padding': 50}, label = "About"),
 ]) #dbc.Tabs
 
+def axis_window(df, start, end, label):
+    #x axis layout showing the rows of df (columns Year and Month, in date order, plotted at x = row) from start to end.
+    #Every third month of the window gets a tick, labelled label % (month, year).
+    years = df.Year.to_numpy()
+    rows = np.flatnonzero((years >= start) & (years <= end))
+    if not len(rows):
+        return dict(autorange = True, tickmode = 'array', tickvals = [], ticktext = [])
+    ticks = rows[(rows - rows[0] + 1) % 3 == 0]
+    return dict(
+        autorange = False,
+        range = [int(rows[0]), int(rows[-1])],
+        tickmode = 'array',
+        tickvals = ticks.tolist(),
+        ticktext = [label % period for period in zip(df.Month.to_numpy()[ticks].tolist(), years[ticks].tolist())])
+
+def window_patch(layout):
+    #A Patch that applies the nested layout dict to a figure already in the browser.
+    patch = dash.Patch()
+    for key, value in layout.items():
+        patch['layout'][key].update(value)
+    return patch
+
+def retail_sales_frames(state):
+    #The state's retail sales and the seasonal bands of each of its months, on the same rows.
+    df = get_retail_sales(state)
+    bands = get_seasonal_bands(state).reindex(df.Month).reset_index(drop = True)
+    return df, bands
+
+def retail_sales_window(df, bands, state, start, end):
+    #Layout showing plot_retail_sales from start to end. The y axis is fitted to the months shown,
+    #as autorange would fit it to a figure holding only those.
+    xaxis = axis_window(df, start, end, "%02d/%d")
+    yaxis = dict(autorange = True)
+    if not xaxis['autorange']:
+        shown = slice(xaxis['range'][0], xaxis['range'][1] + 1)
+        twh = df.TWh.to_numpy()[shown]
+        low = np.fmin(np.nanmin(bands.Min.to_numpy()[shown], initial = np.inf), np.nanmin(twh, initial = np.inf))
+        high = np.fmax(np.nanmax(bands.Max.to_numpy()[shown], initial = -np.inf), np.nanmax(twh, initial = -np.inf))
+        if low <= high:
+            pad = 0.05 * (high - low)
+            yaxis = dict(autorange = False, range = [float(low - pad), float(high + pad)])
+    return dict(
+        xaxis = xaxis,
+        yaxis = yaxis,
+        title = dict(text = "Electricity Consumption and Production, " + rollups.label(state) + ", " + str(start) + " to " + str(end)))
+
+def net_gens_window(df, start, end):
+    return dict(xaxis = axis_window(df, start, end, "%d/%d"))
+
+def loading(key, series_ids, load):
+    #For a callback about to read series_ids: (ids not stored yet, status line, whether to stop polling).
+    #If any aren't stored, load() is started in the background under key, unless it is already running or just failed.
+    #With background loads off it runs here, within fetch's deadline, and the plot is drawn without what EIA didn't send.
+    stored = store.last_periods(series_ids)
+    missing = [series_id for series_id in series_ids if series_id not in stored]
+    if not missing:
+        return [], None, True
+    if not BACKGROUND_LOADS:
+        try:
+            load()
+        except urllib3.exceptions.HTTPError as e:
+            log.warning("load %r failed: %s", key, e)
+            return missing, "Couldn't load " + str(len(missing)) + " series from EIA. Change the selection to try again.", True
+        return [], None, True
+    error = fetch.background.failed(key)
+    if error is not None:
+        return missing, "Couldn't load " + str(len(missing)) + " series from EIA. Change the selection to try again.", True
+    fetch.background.start(key, load)
+    return missing, "Loading " + str(len(missing)) + " series from EIA...", False
+
+def loading_figure(title):
+    #An empty figure, as a plain dict: building a go.Figure costs more than the rest of a loading response.
+    return {'data': [], 'layout': {'title': {'text': title}}}
+
+#Each plot keeps what its figure in the browser was drawn for in a dcc.Store. On the Con/Prod tab, while that still holds,
+#a change of year range is answered with window_patch. While series are loading it holds what was drawn without them,
+#so a poll that finds nothing new sends nothing.
+
 @app.callback(Output('consumption', 'figure'),
+              Output('consumption_view', 'data'),
+              Output('consumption_status', 'children'),
+              Output('consumption_poll', 'disabled'),
+              Input('state_dropdown_1', 'value'),
+              Input('start_1', 'value'),
+              Input('end_1', 'value'),
+              Input('consumption_poll', 'n_intervals'),
+              State('consumption_view', 'data'))
+def update_consumption(state, start, end, n_intervals, view):
+    missing, status, done = loading((state, "retail_sales"), [retail_sales_id(state)], lambda: get_retail_sales(state))
+    if missing:
+        drawn = ['loading', state]
+        fig = dash.no_update if view == drawn else loading_figure("Electricity Consumption and Production, " + rollups.label(state))
+        return fig, drawn, status, done
+
+    drawn = [state, store.data_version()]
+    if RANGE_PATCH and view == drawn:
+        df, bands = retail_sales_frames(state)
+        return window_patch(retail_sales_window(df, bands, state, start, end)), drawn, None, True
+    return plot_retail_sales(state, start, end), drawn, None, True
+
+@app.callback(Output('generation', 'figure'),
+              Output('generation_view', 'data'),
+              Output('generation_status', 'children'),
+              Output('generation_poll', 'disabled'),
               Input('state_dropdown_1', 'value'),
+              Input('fuels', 'value'),
               Input('start_1', 'value'),
-              Input('end_1', 'value'))
+              Input('end_1', 'value'),
+              Input('generation_poll', 'n_intervals'),
+              State('generation_view', 'data'))
+def update_generation(state, fuels, start, end, n_intervals, view):
+    wanted = list(selected_fuels(fuels)) + ["ALL"]
+    missing, status, done = loading((state, "gen_mix"), [net_gen_id(state, fuel) for fuel in wanted], lambda: get_gen_mix(state, wanted))
+    if missing:
+        #Draw the fuels already stored. Fractions are of ALL, so nothing can be drawn without it.
+        loaded = [fuel for fuel in wanted[:-1] if net_gen_id(state, fuel) not in missing]
+        drawn = ['loading', state, loaded, start, end]
+        if view == drawn:
+            fig = dash.no_update
+        elif net_gen_id(state, "ALL") in missing:
+            fig = loading_figure("")
+        else:
+            fig = plot_net_gens(state, loaded, start, end)
+        return fig, drawn, status, done
+
+    #The stacking order follows the year range, so a range that reorders the fuels gets a new figure.
+    drawn = [state, list(selected_fuels(fuels)), get_net_gens_order(state, fuels, start, end), store.data_version()]
+    if RANGE_PATCH and view == drawn:
+        return window_patch(net_gens_window(get_net_gens_months(state, fuels), start, end)), drawn, None, True
+    return plot_net_gens(state, fuels, start, end), drawn, None, True
+
+@cache.memoize_figure(lambda state, start, end: (state, start, end))
 def plot_retail_sales(state, start, end):
-    df = get_retail_sales(state)
-    df = df[(df.Year >= start) & (df.Year <= end)].sort_values(['Year', 'Month']).reset_index(drop = True)
+    df, bands = retail_sales_frames(state)
+    build_start = time.perf_counter()
     fig = go.Figure()
     fig.add_trace(go.Scatter(
         x = df.index,
-        y = df.Min,
+        y = bands.Min,
         line = dict(color = '#c5c6c7'),
         line_shape = 'spline',
         name = "Max, Min"))
     fig.add_trace(go.Scatter(
         x = df.index,
-        y = df.Max,
+        y = bands.Max,
         fill = 'tonexty',
         line = dict(color = '#c5c6c7'),
         line_shape = 'spline',
         showlegend = False))
     fig.add_trace(go.Scatter(
         x = df.index,
-        y = df.Q1,
+        y = bands.Q1,
         line = dict(color = '#1f2833'),
         line_shape = 'spline',
         name = "Q1, Q3"))
     fig.add_trace(go.Scatter(
         x = df.index,
-        y = df.Q3,
+        y = bands.Q3,
         fill = 'tonexty',
         line = dict(color = '#1f2833'),
         line_shape = 'spline',
         showlegend = False))
     fig.add_trace(go.Scatter(
         x = df.index,
-        y = df.iloc[:,2],
+        y = df.TWh,
         line = dict(color = '#fc4445'),
         line_shape = 'spline',
         name = "Retail Sales"))
     
     fig.update_layout(
-        xaxis = dict(
-            tickmode = 'array',
-            ticktext = df.xaxis_labels[(df.index + 1) % 3 == 0],
-            tickvals = df.index[(df.index + 1) % 3 == 0]),
         legend = dict(
             yanchor = "top",
             y = 0.99,
             xanchor = "left",
             x = 0.01),
-        title = "Electricity Consumption and Production, " + state + ", " + str(start) + " to " + str(end),
         xaxis_title = "",
         yaxis_title = "Consumption (TWh)",
         showlegend = True)
+    fig.update_layout(retail_sales_window(df, bands, state, start, end))
 
+    metrics.observe('figure_build', time.perf_counter() - build_start)
     return fig
 
-@app.callback(Output('generation', 'figure'),
-              Input('state_dropdown_1', 'value'),
-              Input('fuels', 'value'),
-              Input('start_1', 'value'),
-              Input('end_1', 'value'))
+@cache.memoize_figure(lambda state, fuels, start, end: (state, selected_fuels(fuels), start, end))
 def plot_net_gens(state, fuels, start, end):
     df = get_net_gens(state, fuels, start, end)
+    build_start = time.perf_counter()
     fig = go.Figure()
     for c in range(2, len(df.columns) - 1):
         fig.add_trace(go.Scatter(
@@ -424,10 +725,6 @@ def plot_net_gens(state, fuels, start, end):
             fill = 'tonexty',
             name = fuel_types[df.columns[c]]))
     fig.update_layout(
-        xaxis = dict(
-            tickmode = 'array',
-            ticktext = df.xaxis_labels[(df.index + 1) % 3 == 0],
-            tickvals = df.index[(df.index + 1) % 3 == 0]),
         yaxis = dict(
             type = 'linear',
             range = [0, 1],
@@ -438,41 +735,65 @@ def plot_net_gens(state, fuels, start, end):
             xanchor = "left",
             x = 0.01)
     )
+    fig.update_layout(net_gens_window(df, start, end))
+    metrics.observe('figure_build', time.perf_counter() - build_start)
     return fig
 
 @app.callback(Output('intensities', 'figure'),
+              Output('intensities_view', 'data'),
+              Output('intensities_status', 'children'),
+              Output('intensities_poll', 'disabled'),
               Input('state_multidropdown_2', 'value'),
               Input('start_2', 'value'),
-              Input('end_2', 'value'))
+              Input('end_2', 'value'),
+              Input('intensities_poll', 'n_intervals'),
+              State('intensities_view', 'data'))
+def update_intensity(states, start, end, n_intervals, view):
+    missing, status, done = loading((None, "intensity_panel"), intensity.series_ids(states), lambda: get_intensity_panel(states))
+    if missing:
+        #Draw the states whose series are all stored.
+        loaded = [state for state in states if not set(intensity.series_ids([state])) & set(missing)]
+        drawn = ['loading', loaded, start, end]
+        if view == drawn:
+            fig = dash.no_update
+        elif loaded:
+            fig = plot_intensity(loaded, start, end)
+        else:
+            fig = loading_figure("GDP and Energy Intensity, " + str(start) + " to " + str(end))
+        return fig, drawn, status, done
+    return plot_intensity(states, start, end), None, None, True
+
+#States keep their selection order in the key, since it sets each path's color.
+@cache.memoize_figure(lambda states, start, end: (tuple(states), start, end))
 def plot_intensity(states, start, end):
     #Label only the bubbles, and put markers along the lines.
-    intensities = []
-    for state in states:
-        tmp = get_intensity(state)
-        tmp = tmp[(tmp.Year >= start) & (tmp.Year <= end)]
-        intensities.append(tmp)
+    panel = get_intensity_panel(states)
+    years = panel.index.get_level_values('Year')
+    intensities = panel[(years >= start) & (years <= end)]
 
+    build_start = time.perf_counter()
     fig = go.Figure()
 
     for i in range(len(states)):
+        df = intensities.loc[states[i]]
         
         #Bubbles. All first bubbles have size 25. All second bubbles have size proportional to first bubble.
         fig.add_trace(go.Scatter(
-            x = [intensities[i].iloc[0,2], intensities[i].iloc[-1,2]],
-            y = [intensities[i].iloc[0,5], intensities[i].iloc[-1,5]],
-            text = intensities[i].iloc[[0,-1], 0],
+            x = [df.real_gdp.iloc[0], df.real_gdp.iloc[-1]],
+            y = [df.perUSD.iloc[0], df.perUSD.iloc[-1]],
+            text = df.index[[0, -1]],
             mode = 'markers+text',
             showlegend = False,
             marker = dict(
-                color = colors[i],
-                size = [25, 25 * (intensities[i].iloc[-1,1]/intensities[i].iloc[0,1])]
+                color = colors[i % len(colors)],
+                size = [25, 25 * (df.population.iloc[-1]/df.population.iloc[0])]
             )
         ))
 
         fig.add_trace(go.Scatter(
-            x = intensities[i].iloc[:, 2], #GDP
-            y = intensities[i].iloc[:, 5], #perUSD
-            line_color = colors[i],
+            x = df.real_gdp,
+            y = df.perUSD,
+            line_color = colors[i % len(colors)],
             mode = 'lines+markers',
             line_shape = 'spline',
             name = states[i]
@@ -487,7 +808,41 @@ def plot_intensity(states, start, end):
             title = "Energy Intensity (thousands of BTUs per dollar)"),
         title = "GDP and Energy Intensity, " + str(start) + " to " + str(end))
     
+    metrics.observe('figure_build', time.perf_counter() - build_start)
     return fig
 
+#Tables served by the data API (see dataapi.py), built from the same frames as the plots.
+
+def retail_sales_table(args):
+    #Monthly retail sales (TWh) with the month's seasonal bands.
+    state = dataapi.choice(args, 'state', places)
+    missing, status, done = loading((state, "retail_sales"), [retail_sales_id(state)], lambda: get_retail_sales(state))
+    if missing:
+        return None
+    return get_retail_sales(state).join(get_seasonal_bands(state), on = 'Month')
+
+def generation_table(args):
+    #Monthly fraction of net generation from each fuel, from start to end.
+    state = dataapi.choice(args, 'state', places)
+    fuels = list(selected_fuels(dataapi.choices(args, 'fuels', ['select_all'] + list(fuel_types), 'select_all'))) + ["ALL"]
+    missing, status, done = loading((state, "gen_mix"), [net_gen_id(state, fuel) for fuel in fuels], lambda: get_gen_mix(state, fuels))
+    if missing:
+        return None
+    return get_gen_mix(state, fuels).fractions(fuels, dataapi.integer(args, 'start'), dataapi.integer(args, 'end'))
+
+def intensity_table(args):
+    #Population, real GDP, energy consumption and their ratios by state and year, from start to end.
+    selected = dataapi.choices(args, 'states', places)
+    start, end = dataapi.integer(args, 'start', 0), dataapi.integer(args, 'end', 9999)
+    missing, status, done = loading((None, "intensity_panel"), intensity.series_ids(selected), lambda: get_intensity_panel(selected))
+    if missing:
+        return None
+    panel = get_intensity_panel(selected).reset_index()
+    return panel[panel.state.isin(selected) & panel.Year.between(start, end)]
+
+dataapi.init_app(server,
+    {'retail_sales': retail_sales_table, 'generation': generation_table, 'intensity': intensity_table},
+    revalidate = [app.config.requests_pathname_prefix + path for path in ['_dash-layout', '_dash-dependencies']])
+
 if __name__ == '__main__':
     app.run_server(debug = True)
\ No newline at end of file
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark: decoding a series response with decode.py against the
+json.loads + pandas string-slicing path it replaced.
+
+By default the payload is a synthetic monthly series from 1973-01 to
+2021-09, as long as the longest monthly series the app reads, written out
+compactly as api.eia.gov does. Pass a recorded response to use that instead.
+
+Run from the repo root:
+
+    python -m benchmarks.decode_bench [response.json]
+"""
+
+import json
+import sys
+import timeit
+import numpy as np
+import pandas as pd
+import decode
+import fetch
+
+def synthetic_response(start = 1973, end = 2021, last_month = 9):
+    rng = np.random.default_rng(608)
+    periods = [(y, m) for y in range(end, start - 1, -1) for m in range(12, 0, -1) if y * 100 + m <= end * 100 + last_month]
+    data = [[str(y) + str(m).zfill(2), float(v)] for (y, m), v in zip(periods, rng.uniform(0, 1e5, len(periods)))]
+    data[len(data) // 2][1] = None
+    payload = {
+        'request': {'command': 'series', 'series_id': 'ELEC.SALES.US-ALL.M'},
+        'series': [{'series_id': 'ELEC.SALES.US-ALL.M', 'units': 'million kilowatthours', 'f': 'M', 'data': data}]}
+    return json.dumps(payload, separators = (',', ':')).encode()
+
+def json_pandas_frame(raw):
+    #The decode and parse steps before decode.py, kept here for comparison.
+    series = json.loads(raw.decode())['series'][0]
+    df = pd.DataFrame(
+        series['data'],
+        columns = ['Date', 'Value'])
+    df['Year'] = df.Date.str.slice(0,4).astype(int)
+    df['Month'] = df.Date.str.slice(4,6).replace('', '0').astype(int)
+    df['Value'] = pd.to_numeric(df.Value, errors = 'coerce')
+    df = df.loc[:, ['Year', 'Month', 'Value']].sort_values(['Year', 'Month']).reset_index(drop = True)
+    return series['units'], df
+
+def best_ms(fn, number):
+    return min(timeit.repeat(fn, number = number, repeat = 5)) / number * 1000
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rb') as f:
+            raw = f.read()
+    else:
+        raw = synthetic_response()
+
+    old = json_pandas_frame(raw)
+    new = fetch.series_frame(*decode.decode_series(raw))
+    assert old[0] == new[0]
+    pd.testing.assert_frame_equal(old[1], new[1])
+
+    old_ms = best_ms(lambda: json_pandas_frame(raw), 200)
+    arrays_ms = best_ms(lambda: decode.decode_series(raw), 200)
+    new_ms = best_ms(lambda: fetch.series_frame(*decode.decode_series(raw)), 200)
+
+    print("%d rows, %d bytes" % (len(new[1]), len(raw)))
+    print("  json.loads + pandas   %8.3f ms" % old_ms)
+    print("  decode, arrays        %8.3f ms  (%.0fx)" % (arrays_ms, old_ms / arrays_ms))
+    print("  decode + series_frame %8.3f ms  (%.0fx)" % (new_ms, old_ms / new_ms))
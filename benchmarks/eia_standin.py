@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the EIA series API, for offline benchmarks.
+
+Answers GET /series/?series_id=...[&start=...] the way api.eia.gov does.
+Payloads are replayed from a directory of recorded responses, one
+<series_id>.json per series; series with no recording get a deterministic
+synthetic payload of the same shape, and a few fuels answer with EIA's
+invalid-series error so the app's fallback path is exercised. Every response
+is delayed by --latency seconds, plus up to --jitter more. To see how the
+app copes with an unhealthy EIA, --error-rate of requests can be answered
+with a 503 and --hang-rate of them held for --hang seconds first.
+
+    python -m benchmarks.eia_standin --port 8608 --latency 0.2
+
+Then start the app with EIA_API_URL="http://127.0.0.1:8608/series/?series_id=".
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+#Fuels the synthetic payloads treat as not generated in any state.
+MISSING_FUELS = {'STH', 'GEO', 'DPV', 'Other'}
+
+def synthetic_payload(series_id):
+    rnd = random.Random(hashlib.md5(series_id.encode()).hexdigest())
+    parts = series_id.split('.')
+    if parts[0] == 'ELEC' and parts[1] == 'GEN' and parts[2].split('-')[0] in MISSING_FUELS:
+        return {'request': {'series_id': series_id}, 'data': {'error': 'invalid series_id. For key registration, documentation, and examples see https://www.eia.gov/developer/'}}
+
+    if series_id.endswith('.A'):
+        units = {'TPOPP': 'Thousand', 'GDPRX': 'Million chained (2012) dollars', 'TETCB': 'Billion Btu'}.get(parts[1], 'Units')
+        scale = rnd.uniform(1e3, 1e6)
+        data = [[str(year), scale * (1 + 0.01 * (year - 1960)) * rnd.uniform(0.97, 1.03)] for year in range(2019, 1959, -1)]
+    else:
+        units = 'thousand megawatthours'
+        scale = rnd.uniform(10, 1e4)
+        data = [[str(year) + str(month).zfill(2), scale * (1.2 + 0.3 * ((month - 1) % 6) / 5) * rnd.uniform(0.9, 1.1)]
+            for year in range(2021, 2000, -1) for month in range(12, 0, -1) if year * 100 + month <= 202109]
+    return {'request': {'series_id': series_id}, 'series': [{'series_id': series_id, 'units': units, 'data': data}]}
+
+class StandIn(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency = 0.0, jitter = 0.0, payload_dir = None, error_rate = 0.0, hang_rate = 0.0, hang = 60.0):
+        super().__init__(address, Handler)
+        self.latency = latency
+        self.jitter = jitter
+        self.payload_dir = payload_dir
+        self.error_rate = error_rate
+        self.hang_rate = hang_rate
+        self.hang = hang
+        self.requests = 0
+
+    def handle_error(self, request, client_address):
+        #Clients that gave up on a held request close the connection; that is expected, not an error.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def payload(self, series_id):
+        if self.payload_dir is not None:
+            path = os.path.join(self.payload_dir, series_id + '.json')
+            if os.path.exists(path):
+                with open(path) as f:
+                    return json.load(f)
+        return synthetic_payload(series_id)
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        payload = self.server.payload(query['series_id'][0])
+        if 'start' in query and 'series' in payload:
+            start = query['start'][0]
+            payload = dict(payload, series = [dict(payload['series'][0],
+                data = [row for row in payload['series'][0]['data'] if row[0] >= start])])
+
+        self.server.requests += 1
+        time.sleep(self.server.latency + random.uniform(0, self.server.jitter))
+        if random.random() < self.server.hang_rate:
+            time.sleep(self.server.hang)
+        status = 503 if random.random() < self.server.error_rate else 200
+        body = json.dumps(payload).encode() if status == 200 else b'Service Unavailable'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(port = 0, latency = 0.0, jitter = 0.0, payload_dir = None, error_rate = 0.0, hang_rate = 0.0, hang = 60.0):
+    #Starts a stand-in on a background thread and returns it; its api_url attribute is the EIA_API_URL to use.
+    server = StandIn(('127.0.0.1', port), latency, jitter, payload_dir, error_rate, hang_rate, hang)
+    server.api_url = "http://127.0.0.1:" + str(server.server_address[1]) + "/series/?api_key=standin&series_id="
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Local stand-in for the EIA series API.")
+    parser.add_argument('--port', type = int, default = 8608)
+    parser.add_argument('--latency', type = float, default = 0.0, help = "seconds added to every response")
+    parser.add_argument('--jitter', type = float, default = 0.0, help = "up to this many more seconds, at random")
+    parser.add_argument('--payloads', default = None, help = "directory of recorded <series_id>.json responses")
+    parser.add_argument('--error-rate', type = float, default = 0.0, help = "fraction of requests answered with a 503")
+    parser.add_argument('--hang-rate', type = float, default = 0.0, help = "fraction of requests held for --hang seconds")
+    parser.add_argument('--hang', type = float, default = 60.0)
+    args = parser.parse_args()
+
+    server = serve(args.port, args.latency, args.jitter, args.payloads, args.error_rate, args.hang_rate, args.hang)
+    print("EIA_API_URL=" + server.api_url)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
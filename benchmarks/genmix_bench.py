@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark: the generation-mix engine against the merge chain it
+replaced, for "(Select all)" fuels over 2001-2021.
+
+Run from the repo root:
+
+    python -m benchmarks.genmix_bench
+"""
+
+import timeit
+from functools import reduce
+import numpy as np
+import pandas as pd
+from app import fuel_types
+import genmix
+
+def synthetic_net_gens(fuels, start = 2001, end = 2021):
+    rng = np.random.default_rng(608)
+    periods = [(y, m) for y in range(start, end + 1) for m in range(1, 13)]
+    frames = {}
+    for fuel in fuels:
+        frames[fuel] = pd.DataFrame({
+            'Year': [y for y, m in periods],
+            'Month': [m for y, m in periods],
+            fuel: rng.uniform(0, 1000, len(periods))})
+    frames["ALL"]["ALL"] = sum(frames[fuel][fuel] for fuel in fuels if fuel != "ALL")
+    return frames
+
+def merge_chain_net_gens(frames, fuels, start, end):
+    #The body of get_net_gens before the engine, kept here for comparison.
+    df_list = []
+    for fuel in fuels:
+        tmp = frames[fuel]
+        tmp = tmp[(tmp.Year >= start) & (tmp.Year <= end)]
+        df_list.append(tmp)
+
+    merged_df = reduce(lambda left, right: pd.merge(left, right, on = ['Year', 'Month'], how = 'outer'), df_list)
+    fuels_by_variance = list(merged_df.iloc[:, 2:].var().sort_values().index)
+    sorted_df = merged_df[fuels_by_variance]
+
+    sorted_asfractions_df = sorted_df.drop(columns = "ALL").div(sorted_df.ALL, axis = 0)
+    cumulative_df = pd.DataFrame({
+        'Year': merged_df.Year,
+        'Month': merged_df.Month})
+    for col in sorted_asfractions_df.columns:
+        cumulative_df[col] = sorted_asfractions_df.loc[:, :col].sum(axis = 1)
+
+    cumulative_df['xaxis_labels'] = cumulative_df.Month.astype(str) + "/" + cumulative_df.Year.astype(str)
+    return cumulative_df.sort_values(['Year', 'Month']).reset_index(drop = True)
+
+def best_ms(fn, number):
+    return min(timeit.repeat(fn, number = number, repeat = 5)) / number * 1000
+
+if __name__ == '__main__':
+    fuels = list(fuel_types) + ["ALL"]
+    frames = synthetic_net_gens(fuels)
+    gen_mix = genmix.GenerationMix.from_frames(frames)
+
+    old = merge_chain_net_gens(frames, fuels, 2001, 2021)
+    new = gen_mix.cumulative(fuels, 2001, 2021)
+    assert list(old.columns) == list(new.columns)
+    assert np.allclose(old.iloc[:, 2:-1].to_numpy(), new.iloc[:, 2:-1].to_numpy())
+
+    merge_ms = best_ms(lambda: merge_chain_net_gens(frames, fuels, 2001, 2021), 20)
+    build_ms = best_ms(lambda: genmix.GenerationMix.from_frames(frames), 20)
+    engine_ms = best_ms(lambda: gen_mix.cumulative(fuels, 2001, 2021), 200)
+
+    print("(Select all), 2001-2021: " + str(len(fuels) - 1) + " fuels x " + str(len(new)) + " months")
+    print("  merge chain       %8.2f ms" % merge_ms)
+    print("  engine, per view  %8.2f ms  (%.0fx)" % (engine_ms, merge_ms / engine_ms))
+    print("  engine, build once%8.2f ms" % build_ms)
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark suite for the three plot callbacks.
+
+Runs every scenario against a local EIA stand-in (benchmarks/eia_standin.py),
+both by calling the callbacks directly and through the Flask server over
+HTTP. Each run is a fresh Python process with an empty store, so the first
+pass over a scenario's inputs is cold and the peak RSS reported is that
+run's own. Reports cold and warm p50/p99 latency, throughput with --clients
+concurrent HTTP clients, and peak RSS.
+
+While a callback's series load in the background it keeps polling, as the
+browser does; cold latency runs until the last poll, and "first" is how long
+the first response, drawn from what was stored, took.
+
+Run from the repo root:
+
+    python -m benchmarks.suite --latency 0.1 --clients 8
+"""
+
+import argparse
+import gzip
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+#Dash graph id and value input ids in argument order. Each callback also takes the graph's <id>_poll interval and
+#<id>_view store, and returns the figure, view, <id>_status text and whether to stop polling.
+CALLBACKS = {
+    'update_consumption': ('consumption', ['state_dropdown_1', 'start_1', 'end_1']),
+    'update_generation': ('generation', ['state_dropdown_1', 'fuels', 'start_1', 'end_1']),
+    'update_intensity': ('intensities', ['state_multidropdown_2', 'start_2', 'end_2']),
+}
+POLL_INTERVAL = 0.05
+
+def scenarios(states):
+    #{name: [(callback name, args)]}. Each scenario's calls are made in order, cold first, then warm.
+    return {
+        'default_view': [
+            ('update_consumption', ('NY', 2019, 2021)),
+            ('update_generation', ('NY', ['COW', 'NUC'], 2019, 2021)),
+            ('update_intensity', (['NY'], 2015, 2019))],
+        'select_all_fuels': [
+            ('update_generation', (state, ['select_all'], 2001, 2021)) for state in ['NY', 'CA', 'TX', 'IA', 'WA', 'LA']],
+        'year_ranges': [
+            ('update_consumption', ('MO', start, 2021)) for start in range(2001, 2021, 2)] + [
+            ('update_generation', ('MO', ['COW', 'NG', 'NUC', 'WND'], start, 2021)) for start in range(2001, 2021, 2)],
+        'rollups': [
+            ('update_consumption', (code, 2001, 2021)) for code in ['US', 'Midwest', 'PJM']] + [
+            ('update_generation', (code, ['select_all'], 2001, 2021)) for code in ['US', 'Midwest', 'PJM']],
+        'intensity_all_states': [
+            ('update_intensity', (list(states), 2001, 2019))],
+    }
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+def dash_request(name, args, view, n_intervals = None):
+    output, inputs = CALLBACKS[name]
+    outputs = [(output, 'figure'), (output + '_view', 'data'), (output + '_status', 'children'), (output + '_poll', 'disabled')]
+    return {
+        'output': '..' + '...'.join(id + '.' + prop for id, prop in outputs) + '..',
+        'outputs': [{'id': id, 'property': prop} for id, prop in outputs],
+        'inputs': [{'id': input_id, 'property': 'value', 'value': value} for input_id, value in zip(inputs, args)] + [
+            {'id': output + '_poll', 'property': 'n_intervals', 'value': n_intervals}],
+        'changedPropIds': [output + '_poll.n_intervals' if n_intervals else inputs[0] + '.value'],
+        'state': [{'id': output + '_view', 'property': 'data', 'value': view}]}
+
+def run_scenario(name, via, warm_rounds, clients, duration, compression = True):
+    #Runs in the child process. Returns the measurements as a dict.
+    import app
+    calls = scenarios(app.states)[name]
+    #The view each callback's figure was last drawn for, as the browser would send it back. Shared by all clients,
+    #as if they were one browser.
+    views = {}
+    sizes = []
+
+    if via == 'direct':
+        def call(name, args, n_intervals):
+            fig, views[name], status, done = getattr(app, name)(*args, n_intervals, views.get(name))
+            return done
+    else:
+        import urllib3
+        from werkzeug.serving import make_server
+        server = make_server('127.0.0.1', 0, app.server, threaded = True)
+        threading.Thread(target = server.serve_forever, daemon = True).start()
+        url = "http://127.0.0.1:" + str(server.server_port)
+        http = urllib3.PoolManager(maxsize = max(clients, 1))
+        http.request('GET', url + '/')
+
+        headers = {'Content-Type': 'application/json', 'Accept-Encoding': 'gzip' if compression else 'identity'}
+        def call(name, args, n_intervals):
+            r = http.request('POST', url + '/_dash-update-component',
+                body = json.dumps(dash_request(name, args, views.get(name), n_intervals)), headers = headers, decode_content = False)
+            if r.status != 200:
+                raise RuntimeError(name + " returned HTTP " + str(r.status))
+            #Bytes as sent, before decompression.
+            sizes.append(len(r.data))
+            output = CALLBACKS[name][0]
+            response = json.loads(gzip.decompress(r.data) if r.headers.get('Content-Encoding') == 'gzip' else r.data)['response']
+            if output + '_view' in response:
+                views[name] = response[output + '_view']['data']
+            return response[output + '_poll']['disabled']
+
+    first = []
+    def timed(name, args):
+        #Calls, then polls until the callback stops its interval. Returns the time to the last response.
+        t = time.perf_counter()
+        done = call(name, args, None)
+        first.append(time.perf_counter() - t)
+        n_intervals = 0
+        while not done:
+            time.sleep(POLL_INTERVAL)
+            n_intervals += 1
+            done = call(name, args, n_intervals)
+        return time.perf_counter() - t
+
+    res = {'cold': [timed(name, args) for name, args in calls]}
+    res['first'] = list(first)
+    res['warm'] = [timed(name, args) for _ in range(warm_rounds) for name, args in calls]
+
+    if via == 'http' and clients > 0:
+        done = []
+        deadline = time.perf_counter() + duration
+        def client(offset):
+            i = offset
+            while time.perf_counter() < deadline:
+                done.append(timed(*calls[i % len(calls)]))
+                i += 1
+        threads = [threading.Thread(target = client, args = (i,)) for i in range(clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        res['throughput'] = len(done) / duration
+        res['loaded'] = done
+
+    res['rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sizes:
+        res['response_bytes'] = sum(sizes) / len(sizes)
+    return res
+
+def main():
+    parser = argparse.ArgumentParser(description = "Offline benchmarks for the plot callbacks.")
+    parser.add_argument('--scenario', action = 'append', help = "run only this scenario (repeatable)")
+    parser.add_argument('--via', choices = ['direct', 'http', 'both'], default = 'both')
+    parser.add_argument('--latency', type = float, default = 0.05, help = "stand-in latency per EIA request, seconds")
+    parser.add_argument('--jitter', type = float, default = 0.0)
+    parser.add_argument('--payloads', default = None, help = "directory of recorded <series_id>.json responses")
+    parser.add_argument('--error-rate', type = float, default = 0.0, help = "fraction of EIA requests the stand-in fails with a 503")
+    parser.add_argument('--hang-rate', type = float, default = 0.0, help = "fraction of EIA requests the stand-in holds for --hang seconds")
+    parser.add_argument('--hang', type = float, default = 60.0)
+    parser.add_argument('--warm-rounds', type = int, default = 10)
+    parser.add_argument('--clients', type = int, default = 8, help = "concurrent HTTP clients for throughput")
+    parser.add_argument('--duration', type = float, default = 5.0, help = "seconds of throughput load")
+    parser.add_argument('--no-figure-cache', action = 'store_true', help = "measure warm calls without the figure cache")
+    parser.add_argument('--no-range-patch', action = 'store_true', help = "answer year-range changes with whole figures")
+    parser.add_argument('--no-background-loads', action = 'store_true', help = "wait on EIA inside the callbacks")
+    parser.add_argument('--no-compression', action = 'store_true', help = "ask for uncompressed HTTP responses")
+    parser.add_argument('--child', nargs = 2, metavar = ('SCENARIO', 'VIA'), help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        res = run_scenario(args.child[0], args.child[1], args.warm_rounds, args.clients, args.duration, not args.no_compression)
+        sys.stdout.write('\n' + json.dumps(res) + '\n')
+        return
+
+    from benchmarks import eia_standin
+    standin = eia_standin.serve(latency = args.latency, jitter = args.jitter, payload_dir = args.payloads,
+        error_rate = args.error_rate, hang_rate = args.hang_rate, hang = args.hang)
+    names = args.scenario or list(scenarios([]))
+    vias = ['direct', 'http'] if args.via == 'both' else [args.via]
+
+    print("EIA stand-in latency %.0f ms, %d warm rounds, %d clients for %.0f s%s%s%s%s" % (
+        args.latency * 1000, args.warm_rounds, args.clients, args.duration,
+        ", no figure cache" if args.no_figure_cache else "", ", no range patches" if args.no_range_patch else "",
+        ", no background loads" if args.no_background_loads else "", ", uncompressed" if args.no_compression else ""))
+    if args.error_rate or args.hang_rate:
+        print("%.0f%% of EIA requests fail, %.0f%% hang for %.0f s" % (args.error_rate * 100, args.hang_rate * 100, args.hang))
+    print("%-22s %-6s %9s %9s %9s %9s %9s %8s %9s %8s %8s" % (
+        'scenario', 'via', 'first p99', 'cold p50', 'cold p99', 'warm p50', 'warm p99', 'EIA reqs', 'req/s', 'KB/resp', 'RSS MB'))
+
+    for name in names:
+        for via in vias:
+            with tempfile.TemporaryDirectory() as tmp:
+                env = dict(os.environ,
+                    EIA_API_URL = standin.api_url,
+                    EIA_STORE_PATH = os.path.join(tmp, 'store.sqlite'),
+                    EIA_REFRESH_TTL = '0')
+                if args.no_figure_cache:
+                    env['FIGURE_CACHE_BYTES'] = '0'
+                if args.no_range_patch:
+                    env['EIA_RANGE_PATCH'] = '0'
+                if args.no_background_loads:
+                    env['EIA_BACKGROUND_LOADS'] = '0'
+                requests_before = standin.requests
+                out = subprocess.run(
+                    [sys.executable, '-W', 'ignore', '-m', 'benchmarks.suite', '--child', name, via,
+                        '--warm-rounds', str(args.warm_rounds), '--clients', str(args.clients), '--duration', str(args.duration)]
+                        + (['--no-compression'] if args.no_compression else []),
+                    env = env, capture_output = True, text = True, check = True).stdout
+            res = json.loads(out.strip().splitlines()[-1])
+            print("%-22s %-6s %7.1fms %7.1fms %7.1fms %7.2fms %7.2fms %8d %9s %8s %8.0f" % (
+                name, via, percentile(res['first'], 0.99) * 1000,
+                percentile(res['cold'], 0.5) * 1000, percentile(res['cold'], 0.99) * 1000,
+                percentile(res['warm'], 0.5) * 1000, percentile(res['warm'], 0.99) * 1000,
+                standin.requests - requests_before,
+                "%.1f" % res['throughput'] if 'throughput' in res else '-',
+                "%.1f" % (res['response_bytes'] / 1024) if 'response_bytes' in res else '-',
+                res['rss_kb'] / 1024))
+
+if __name__ == '__main__':
+    main()
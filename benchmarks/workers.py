@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Worker boot time and memory under gunicorn, with and without preloading.
+
+Fills a temporary store with warmup.py from the EIA stand-in, then for each
+mode starts `gunicorn app:server` with --workers workers. It times how long
+it takes until every worker has answered, then reads each process's memory
+from /proc/<pid>/smaps_rollup, once after boot and once after a round of
+every state's views. RSS counts shared pages in full in every process; PSS
+splits them between the processes sharing them, and USS is what each
+process holds alone. The total PSS of master and workers is the app's real
+footprint. Linux only.
+
+Run from the repo root:
+
+    python -m benchmarks.workers --workers 4
+"""
+
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib3
+from benchmarks import eia_standin
+from benchmarks.suite import dash_request
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def children(pid):
+    res = []
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open('/proc/' + entry + '/stat') as f:
+                    stat = f.read()
+            except OSError:
+                continue
+            if int(stat.rsplit(')', 1)[1].split()[1]) == pid:
+                res.append(int(entry))
+    return res
+
+def memory(pid):
+    #{'rss', 'pss', 'uss'} in MB.
+    fields = {}
+    with open('/proc/' + str(pid) + '/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1]) / 1024
+    return {'rss': fields['Rss'], 'pss': fields['Pss'], 'uss': fields['Private_Clean'] + fields['Private_Dirty']}
+
+def wait_for_workers(master, url, n, timeout = 120):
+    #Polls /metrics on fresh connections until n distinct worker pids have answered.
+    http = urllib3.PoolManager(retries = False)
+    pids = set()
+    deadline = time.perf_counter() + timeout
+    while len(pids) < n:
+        if master.poll() is not None:
+            raise RuntimeError("gunicorn exited with status " + str(master.returncode))
+        if time.perf_counter() > deadline:
+            raise RuntimeError("only " + str(len(pids)) + " workers answered")
+        try:
+            r = http.request('GET', url + '/metrics', headers = {'Connection': 'close'}, timeout = 5)
+        except urllib3.exceptions.HTTPError:
+            time.sleep(0.05)
+            continue
+        for line in r.data.decode().splitlines():
+            if 'pid="' in line:
+                pids.add(line.split('pid="')[1].split('"')[0])
+                break
+
+def view_all_states(url, states, clients, rounds):
+    calls = []
+    for state in states:
+        calls.append(('update_consumption', (state, 2001, 2021)))
+        calls.append(('update_generation', (state, ['select_all'], 2001, 2021)))
+    calls.append(('update_intensity', (list(states), 2001, 2019)))
+    calls = calls * rounds
+
+    http = urllib3.PoolManager(maxsize = clients)
+    def client(offset):
+        for name, args in calls[offset::clients]:
+            r = http.request('POST', url + '/_dash-update-component',
+                body = json.dumps(dash_request(name, args, None)), headers = {'Content-Type': 'application/json'})
+            if r.status != 200:
+                raise RuntimeError(name + " returned HTTP " + str(r.status))
+    threads = [threading.Thread(target = client, args = (i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+def report(mode, stage, boot, master, workers):
+    mem = [memory(pid) for pid in workers]
+    mean = {k: sum(m[k] for m in mem) / len(mem) for k in ['rss', 'pss', 'uss']}
+    print("%-11s %-13s %7s %9.0f %9.0f %9.0f %10.0f" % (
+        mode, stage, "%.2fs" % boot if boot is not None else '', mean['rss'], mean['pss'], mean['uss'],
+        memory(master)['pss'] + sum(m['pss'] for m in mem)))
+
+def main():
+    parser = argparse.ArgumentParser(description = "gunicorn worker boot time and memory, with and without preloading.")
+    parser.add_argument('--workers', type = int, default = 4)
+    parser.add_argument('--clients', type = int, default = 8)
+    parser.add_argument('--rounds', type = int, default = 2, help = "passes over every state's views after boot")
+    args = parser.parse_args()
+
+    standin = eia_standin.serve()
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ,
+            EIA_API_URL = standin.api_url,
+            EIA_STORE_PATH = os.path.join(tmp, 'store.sqlite'),
+            EIA_REFRESH_TTL = '0',
+            PYTHONWARNINGS = 'ignore')
+        subprocess.run([sys.executable, 'warmup.py'], env = env, check = True, stdout = subprocess.DEVNULL)
+        os.environ.update(env)
+        import app
+        states = app.states
+
+        print("%d workers; memory in MB, per worker except total PSS" % args.workers)
+        print("%-11s %-13s %7s %9s %9s %9s %10s" % ('mode', 'measured', 'boot', 'RSS', 'PSS', 'USS', 'total PSS'))
+        for mode, preload in [('no preload', '0'), ('preload', '1')]:
+            port = free_port()
+            url = 'http://127.0.0.1:' + str(port)
+            start = time.perf_counter()
+            master = subprocess.Popen(
+                [sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()', '--workers', str(args.workers), '--bind', '127.0.0.1:' + str(port), 'app:server'],
+                env = dict(env, EIA_PRELOAD = preload), stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+            try:
+                wait_for_workers(master, url, args.workers)
+                boot = time.perf_counter() - start
+                workers = children(master.pid)
+                report(mode, 'after boot', boot, master.pid, workers)
+                view_all_states(url, states, args.clients, args.rounds)
+                report(mode, 'after views', None, master.pid, workers)
+            finally:
+                master.send_signal(signal.SIGTERM)
+                master.wait()
+        print("EIA requests after warm-up: " + str(standin.requests - len(app.all_series_ids(states))))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+In-process caches.
+
+`frames` holds the per-state frames the plots are drawn from (retail sales,
+seasonal bands, generation matrices, intensity). It is bounded by
+DATA_CACHE_BYTES and entries expire after DATA_CACHE_TTL seconds, or as soon
+as the store's data_version moves on, after which they are re-read from the
+store. Entries use compact dtypes, so the whole dataset fits in a few
+megabytes.
+
+`figures` holds the serialized JSON of figures the plot callbacks have built,
+keyed on their normalized inputs and the store's data_version, and bounded by
+FIGURE_CACHE_BYTES. A repeat view is a dict lookup and a json.loads; pandas
+and Plotly are never touched.
+
+Both evict least-recently-used entries once over budget; report() gives
+their current size.
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+import metrics
+import store
+
+def sizeof(value):
+    #Bytes held by a cached frame or array-backed object.
+    if hasattr(value, 'memory_usage'):
+        return int(value.memory_usage(deep = True).sum())
+    return int(value.nbytes)
+
+class LRUCache:
+    #A least-recently-used map bounded by the total sizeof() of its values, with optional expiry.
+    #If version is given, entries put under an older version() are treated as expired.
+
+    def __init__(self, max_bytes, ttl = None, sizeof = len, version = None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.version = version
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+    def get(self, key):
+        version = self.version() if self.version is not None else None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (
+                    (self.ttl is not None and time.time() - entry[2] > self.ttl) or entry[3] != version):
+                self._drop(key)
+                self.stats['expirations'] += 1
+                entry = None
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def peek(self, key):
+        #(value, version) held for key even if it has expired, without touching stats or recency.
+        with self.lock:
+            entry = self.entries.get(key)
+            return (entry[0], entry[3]) if entry is not None else (None, None)
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        version = self.version() if self.version is not None else None
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (value, size, time.time(), version)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._drop(next(iter(self.entries)))
+                self.stats['evictions'] += 1
+
+    def pop(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def report(self):
+        with self.lock:
+            return dict(self.stats, entries = len(self.entries), bytes = self.bytes, max_bytes = self.max_bytes)
+
+    def _drop(self, key):
+        self.bytes -= self.entries.pop(key)[1]
+
+frames = LRUCache(
+    int(os.environ.get('DATA_CACHE_BYTES', 16 * 1024 * 1024)),
+    ttl = float(os.environ.get('DATA_CACHE_TTL', 3600)),
+    sizeof = sizeof,
+    version = store.data_version)
+
+figures = LRUCache(int(os.environ.get('FIGURE_CACHE_BYTES', 32 * 1024 * 1024)))
+
+def memoize_figure(key_fn):
+    #Caches a plot callback's figure as JSON. key_fn maps the callback's arguments to a hashable,
+    #normalized key: two argument lists with the same key must draw the same figure.
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args):
+            key = (fn.__name__, store.data_version()) + tuple(key_fn(*args))
+            fig_json = figures.get(key)
+            if fig_json is not None:
+                return json.loads(fig_json)
+            with metrics.span('callback'):
+                fig = fn(*args)
+            with metrics.span('figure_serialize'):
+                figures.put(key, fig.to_json())
+            return fig
+        return wrapper
+    return decorator
+
+@metrics.collector
+def cache_metrics():
+    reports = [('frames', frames.report()), ('figures', figures.report())]
+    for stat in ['hits', 'misses', 'evictions', 'expirations']:
+        yield ('eia_cache_' + stat + '_total', 'counter', "Cache " + stat + ".",
+            [({'cache': name}, report[stat]) for name, report in reports])
+    yield ('eia_cache_bytes', 'gauge', "Bytes held by the cache.", [({'cache': name}, report['bytes']) for name, report in reports])
+    yield ('eia_cache_entries', 'gauge', "Entries held by the cache.", [({'cache': name}, report['entries']) for name, report in reports])
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Read-only data API, and compression and revalidation for every response.
+
+GET /data/<table>.csv serves the frames the plots are drawn from as CSV,
+e.g. /data/retail_sales.csv?state=NY (the tables are registered by app.py).
+A body is built once per store data_version and kept with its SHA-1, which
+is sent as its ETag. Cache-Control lets browsers and CDNs reuse it for
+EIA_DATA_MAX_AGE seconds; after that a request with If-None-Match gets a
+304 unless the data has changed. While a table's series are still being
+loaded from EIA it answers 503 with Retry-After.
+
+Responses the client accepts compressed (Dash callbacks, the layout, the
+page, CSV and the JavaScript bundles) are sent with brotli if it is
+installed, else gzip. Compressed bundles are kept, so each worker
+compresses them once. The layout and the callback graph only change with a
+deploy, so they get ETags and Cache-Control: no-cache, and a reload
+revalidates them with a 304 instead of fetching them again. (The page
+itself carries a per-request token, so it can't be revalidated.)
+"""
+
+import gzip
+import hashlib
+import os
+import threading
+import zlib
+import flask
+import cache
+import metrics
+import store
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MAX_AGE = int(os.environ.get('EIA_DATA_MAX_AGE', 3600))
+MIN_COMPRESS_BYTES = 500
+#Bodies built per request are compressed fast: on figure JSON, gzip's level 6 saves 3% over level 1
+#and takes half as long again. Static bundles are compressed once, so as small as possible.
+GZIP_LEVEL = 1
+BROTLI_QUALITY = 4
+STATIC_GZIP_LEVEL = 9
+STATIC_BROTLI_QUALITY = 11
+
+COMPRESSIBLE = {'application/json', 'text/html', 'text/csv', 'text/plain'}
+STATIC = {'application/javascript', 'text/javascript', 'text/css'}
+
+#(CSV body, ETag) of tables by request, and compressed static bodies by content.
+bodies = cache.LRUCache(int(os.environ.get('DATA_API_CACHE_BYTES', 8 * 1024 * 1024)),
+    sizeof = lambda entry: len(entry[0]), version = store.data_version)
+compressed = cache.LRUCache(int(os.environ.get('COMPRESSED_CACHE_BYTES', 16 * 1024 * 1024)))
+
+_lock = threading.Lock()
+stats = {}
+
+def init_app(server, tables, revalidate):
+    #tables is {name: fn(args)}; fn returns a DataFrame, or None while its series are loading.
+    #revalidate holds the paths that get ETags and no-cache.
+    server.add_url_rule('/data/<name>.csv', 'data', lambda name: serve_table(tables, name))
+    revalidate = set(revalidate)
+    server.after_request(lambda response: compress(revalidated(response, revalidate)))
+
+def choice(args, name, choices, default = None):
+    #Query argument name, which must be one of choices.
+    value = args.get(name, default)
+    if value not in choices:
+        flask.abort(400, name + " must be one of " + ", ".join(map(str, choices)))
+    return value
+
+def choices(args, name, allowed, default = None):
+    #Comma-separated query argument name, as a list of values from allowed.
+    value = args.get(name, default)
+    values = value.split(',') if value else []
+    if not values or any(v not in allowed for v in values):
+        flask.abort(400, name + " must be a comma-separated list of " + ", ".join(map(str, allowed)))
+    return values
+
+def integer(args, name, default = None):
+    value = args.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        flask.abort(400, name + " must be an integer")
+
+def serve_table(tables, name):
+    if name not in tables:
+        flask.abort(404)
+    key = (name,) + tuple(sorted(flask.request.args.items(multi = True)))
+    entry = bodies.get(key)
+    if entry is None:
+        df = tables[name](flask.request.args)
+        if df is None:
+            response = flask.Response("Loading from EIA, try again shortly.\n", status = 503, mimetype = 'text/plain')
+            response.headers['Retry-After'] = '1'
+            response.cache_control.no_store = True
+            return response
+        with metrics.span('csv_serialize'):
+            body = df.to_csv(index = False).encode()
+        entry = (body, hashlib.sha1(body).hexdigest())
+        bodies.put(key, entry)
+
+    response = flask.Response(entry[0], mimetype = 'text/csv')
+    response.set_etag(entry[1])
+    response.cache_control.public = True
+    response.cache_control.max_age = MAX_AGE
+    return response.make_conditional(flask.request)
+
+def revalidated(response, paths):
+    request = flask.request
+    if (request.method == 'GET' and request.path in paths and response.status_code == 200
+            and not response.direct_passthrough and response.get_etag()[0] is None):
+        response.add_etag()
+        response.cache_control.no_cache = True
+        response.make_conditional(request)
+    return response
+
+def compress(response):
+    static = response.mimetype in STATIC
+    if (response.status_code != 200 or response.direct_passthrough or 'Content-Encoding' in response.headers
+            or not (static or response.mimetype in COMPRESSIBLE)):
+        return response
+    response.vary.add('Accept-Encoding')
+    accept = flask.request.accept_encodings
+    if brotli is not None and accept['br']:
+        encoding = 'br'
+    elif accept['gzip']:
+        encoding = 'gzip'
+    else:
+        return response
+    data = response.get_data()
+    if len(data) < MIN_COMPRESS_BYTES:
+        return response
+
+    with metrics.span('compress'):
+        key = (encoding, len(data), zlib.crc32(data)) if static else None
+        body = compressed.get(key) if static else None
+        if body is None:
+            if encoding == 'br':
+                body = brotli.compress(data, quality = STATIC_BROTLI_QUALITY if static else BROTLI_QUALITY)
+            else:
+                body = gzip.compress(data, compresslevel = STATIC_GZIP_LEVEL if static else GZIP_LEVEL, mtime = 0)
+            if static:
+                compressed.put(key, body)
+    with _lock:
+        counts = stats.setdefault(encoding, {'responses': 0, 'raw_bytes': 0, 'sent_bytes': 0})
+        counts['responses'] += 1
+        counts['raw_bytes'] += len(data)
+        counts['sent_bytes'] += len(body)
+
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    #The compressed body is a different representation, so a strong ETag becomes a weak one.
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak = True)
+    return response
+
+@metrics.collector
+def compression_metrics():
+    with _lock:
+        items = sorted((encoding, dict(counts)) for encoding, counts in stats.items())
+    yield ('eia_compressed_responses_total', 'counter', "Responses sent compressed, by encoding.",
+        [({'encoding': encoding}, counts['responses']) for encoding, counts in items])
+    yield ('eia_compressed_bytes_total', 'counter', "Bytes of compressed responses before and after compression.",
+        [({'encoding': encoding, 'stage': stage}, counts[stage + '_bytes']) for encoding, counts in items for stage in ['raw', 'sent']])
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Decoder for EIA series responses.
+
+A series response is a little metadata around one large array of
+[date, value] rows. Decoding it with json.loads builds a list, a string and
+a float per row, which pandas then has to walk again. Here the data array is
+cut out of the raw bytes, turned into a whitespace-separated run of numbers
+with bytes.translate, and parsed in a single np.fromstring call. Only the
+metadata is decoded as JSON, with ujson.
+
+Periods come back packed as Year * 100 + Month, with Month 0 for annual
+series, and values as float64 with NaN for nulls. Payloads this path doesn't
+understand, such as quarterly dates or text in place of a value, fall back to
+decoding everything with ujson. A quarter (2021Q1) is dated by its first
+month.
+
+Lines of EIA's bulk download files (one series object per line) are decoded
+the same way by decode_bulk_line.
+"""
+
+import re
+import numpy as np
+import ujson
+
+_series_key = re.compile(rb'"series"\s*:')
+_data_key = re.compile(rb'"data"\s*:\s*\[')
+
+#Bytes that are dropped or turned into separators inside the data array.
+_to_space = bytes.maketrans(b'[]",', b'    ')
+_numeric = b'0123456789.-+eE \t\r\n'
+
+def decode_series(raw):
+    #raw is the body of a series request. Returns (units, periods, values) for its first series, periods
+    #an int64 array of Year * 100 + Month in the order EIA sent them, or None if EIA returned no series.
+    key = _series_key.search(raw)
+    split = _split_data(raw, key.end()) if key else None
+    if split is not None:
+        arrays = _decode_rows(split[1])
+        if arrays is not None:
+            return (ujson.loads(split[0])['series'][0]['units'],) + arrays
+    payload = ujson.loads(raw)
+    if 'series' not in payload:
+        return None
+    series = payload['series'][0]
+    return (series['units'],) + _decode_rows_slow(series['data'])
+
+def decode_bulk_line(line):
+    #line is one line of an EIA bulk download file (e.g. ELEC.txt), which holds one series or category.
+    #Returns (series_id, units, periods, values) as decode_series does, or None for lines that aren't series.
+    split = _split_data(line, 0)
+    if split is not None:
+        arrays = _decode_rows(split[1])
+        if arrays is not None:
+            meta = ujson.loads(split[0])
+            if 'series_id' not in meta:
+                return None
+            return (meta['series_id'], meta.get('units')) + arrays
+    series = ujson.loads(line)
+    if 'series_id' not in series or 'data' not in series:
+        return None
+    return (series['series_id'], series.get('units')) + _decode_rows_slow(series['data'])
+
+def _split_data(raw, pos):
+    #(raw with its first data array after pos emptied, the array's bytes), or None if there is none.
+    data = _data_key.search(raw, pos)
+    if data is None:
+        return None
+    start = data.end() - 1
+    end = raw.find(b']', data.end())
+    if end == -1:
+        return None
+    if raw[data.end():end].strip():
+        #Non-empty array: it ends at the first "]]", since rows hold no brackets.
+        end = raw.find(b']]', data.end())
+        if end == -1:
+            return None
+        end += 1
+    return raw[:start] + b'[]' + raw[end + 1:], raw[start:end + 1]
+
+def _decode_rows(segment):
+    #segment is the bytes of a [[date, value], ...] array. Returns (periods, values), or None if it holds
+    #anything other than YYYY or YYYYMM dates and numbers or nulls.
+    rows = segment.count(b'[') - 1
+    if rows == 0:
+        return np.empty(0, dtype = np.int64), np.empty(0, dtype = np.float64)
+    text = segment.translate(_to_space)
+    if text.replace(b'null', b'').translate(None, _numeric):
+        return None
+    tokens = np.fromstring(text.replace(b'null', b'nan'), sep = ' ')
+    if len(tokens) != 2 * rows:
+        return None
+    periods = tokens[0::2].astype(np.int64)
+    if periods.min() < 1000 or periods.max() > 999912:
+        return None
+    return np.where(periods < 10000, periods * 100, periods), tokens[1::2].copy()
+
+def _decode_rows_slow(data):
+    periods = np.array([_period(date) for date, value in data], dtype = np.int64)
+    values = np.array([_number(value) for date, value in data], dtype = np.float64)
+    return periods, values
+
+def _period(date):
+    #Year * 100 + Month for a YYYY, YYYYMM or YYYYQn date.
+    if date[4:5] == 'Q':
+        return int(date[:4]) * 100 + int(date[5:]) * 3 - 2
+    return int(date[:4]) * 100 + int(date[4:6] or 0)
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP access to the EIA API.
+
+All requests share one keep-alive connection pool. Batches of series are
+fetched concurrently, so a batch takes about as long as its slowest request
+rather than the sum of all of them. Set EIA_FETCH_CONCURRENCY to change how
+many requests may be in flight at once.
+
+Concurrent callers asking for the same series share one fetch through
+`flights`, so a popular state picked by several users at once costs one
+upstream request.
+
+Series responses are decoded straight into typed arrays by decode.py.
+
+Every request has a deadline: it must be answered within EIA_FETCH_DEADLINE
+seconds of starting, each attempt within EIA_FETCH_TIMEOUT. A request queued
+behind others in a batch gets its full deadline once it starts, so a large
+batch over a slow link isn't cut short. Connection errors, timeouts,
+429s and 5xx responses are retried up to EIA_FETCH_RETRIES times, after a
+jittered, exponentially growing pause that never runs past the deadline.
+`breaker` counts consecutive failed attempts. After EIA_BREAKER_FAILURES of
+them it opens, and for EIA_BREAKER_COOLDOWN seconds requests fail at once
+with Unavailable instead of waiting on EIA. Then one request is let through
+to probe whether EIA has recovered. Everything already stored keeps being
+served meanwhile; refresh.py revalidates it once EIA answers again.
+
+Callbacks that would have to wait on EIA hand the load to `background`
+instead and draw what is already stored (see app.py).
+"""
+
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+import urllib3
+import numpy as np
+import pandas as pd
+import decode
+import metrics
+
+#EIA_API_URL points the app at another server speaking the same API, e.g. benchmarks/eia_standin.py.
+api_url = os.environ.get('EIA_API_URL', "https://api.eia.gov/series/?api_key=c0b197bcf4610007c7e977fccc486830&series_id=")
+
+CONCURRENCY = int(os.environ.get('EIA_FETCH_CONCURRENCY', 8))
+TIMEOUT = float(os.environ.get('EIA_FETCH_TIMEOUT', 5))
+DEADLINE = float(os.environ.get('EIA_FETCH_DEADLINE', 15))
+RETRIES = int(os.environ.get('EIA_FETCH_RETRIES', 2))
+BACKOFF = 0.2
+BACKOFF_MAX = 2.0
+
+log = logging.getLogger(__name__)
+
+http = urllib3.PoolManager(maxsize = CONCURRENCY, block = True)
+executor = ThreadPoolExecutor(max_workers = CONCURRENCY, thread_name_prefix = 'eia-fetch')
+
+def _reset_after_fork():
+    #Threads and sockets don't survive a fork, so a worker forked from a master that fetched starts its own.
+    global http, executor
+    http = urllib3.PoolManager(maxsize = CONCURRENCY, block = True)
+    executor = ThreadPoolExecutor(max_workers = CONCURRENCY, thread_name_prefix = 'eia-fetch')
+    background.reset()
+    breaker.reset()
+
+os.register_at_fork(after_in_child = _reset_after_fork)
+
+class Unavailable(urllib3.exceptions.HTTPError):
+    #Raised without asking EIA: the breaker is open or the request's deadline has passed.
+    pass
+
+class CircuitBreaker:
+    """
+    Opens after `failures` consecutive failed attempts, so callers stop
+    waiting on an EIA that is down or hanging. While open, allow() is False.
+    After `cooldown` seconds it lets a single probe through: success closes
+    it, failure opens it for another cooldown.
+
+    stats counts attempts that failed ('failures'), times it opened
+    ('opened') and requests turned away while open ('rejected').
+    """
+
+    def __init__(self, failures, cooldown):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.stats = {'failures': 0, 'opened': 0, 'rejected': 0}
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.consecutive = 0
+        self.opened_at = None
+        self.probing = False
+
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return 'closed'
+            return 'half_open' if self.probing or time.monotonic() - self.opened_at >= self.cooldown else 'open'
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if not self.probing and time.monotonic() - self.opened_at >= self.cooldown:
+                self.probing = True
+                return True
+            self.stats['rejected'] += 1
+            return False
+
+    def success(self):
+        with self.lock:
+            self.consecutive = 0
+            self.opened_at = None
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.consecutive += 1
+            self.stats['failures'] += 1
+            if self.probing or (self.opened_at is None and self.consecutive >= self.failures):
+                if not self.probing:
+                    self.stats['opened'] += 1
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+breaker = CircuitBreaker(int(os.environ.get('EIA_BREAKER_FAILURES', 5)), float(os.environ.get('EIA_BREAKER_COOLDOWN', 30)))
+retries = {'retried': 0, 'gave_up': 0}
+_retries_lock = threading.Lock()
+
+def fetch_raw(url, deadline = None):
+    #deadline is a time.monotonic() by which the request must be answered, DEADLINE seconds from now by default.
+    if deadline is None:
+        deadline = time.monotonic() + DEADLINE
+    attempt = 0
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise Unavailable("deadline passed before EIA answered " + url)
+        if not breaker.allow():
+            raise Unavailable("EIA circuit breaker open, not requesting " + url)
+        try:
+            with metrics.span('eia_request'):
+                r = http.request('GET', url, retries = False, timeout = urllib3.Timeout(total = min(TIMEOUT, remaining)))
+        except urllib3.exceptions.HTTPError as e:
+            error = e
+        else:
+            if r.status != 429 and r.status < 500:
+                #Anything EIA answers, even a 4xx, shows it is up.
+                breaker.success()
+                if r.status >= 400:
+                    raise urllib3.exceptions.HTTPError("EIA returned HTTP " + str(r.status) + " for " + url)
+                return r.data
+            error = urllib3.exceptions.HTTPError("EIA returned HTTP " + str(r.status) + " for " + url)
+
+        breaker.failure()
+        #Full jitter: a pause drawn from [0, BACKOFF * 2 ** attempt], so retries from many callers spread out.
+        pause = random.uniform(0, min(BACKOFF_MAX, BACKOFF * 2 ** attempt))
+        give_up = attempt >= RETRIES or time.monotonic() + pause >= deadline
+        with _retries_lock:
+            retries['gave_up' if give_up else 'retried'] += 1
+        if give_up:
+            raise error
+        attempt += 1
+        time.sleep(pause)
+
+def fetch_series(url, deadline = None):
+    #(units, df) for the first series of a series request, as series_frame returns, or None if EIA has no such series.
+    raw = fetch_raw(url, deadline)
+    with metrics.span('json_decode'):
+        decoded = decode.decode_series(raw)
+    return series_frame(*decoded) if decoded is not None else None
+
+def fetch_series_or_error(url, deadline = None):
+    #fetch_series, returning rather than raising the error if EIA fails, so one failed request doesn't cost
+    #fetch_many the rest of its batch.
+    try:
+        return fetch_series(url, deadline)
+    except urllib3.exceptions.HTTPError as e:
+        return e
+
+@metrics.timed('eia_batch')
+def fetch_many(urls, get):
+    #Results of get(url) come back in the same order as urls. Each request's deadline starts when it does.
+    if len(urls) <= 1:
+        return [get(url) for url in urls]
+    return list(executor.map(get, urls))
+
+def fetch_completed(urls, get):
+    #(url, get(url)) pairs for urls, in the order the requests finish, so each result can be used as it arrives.
+    #The eia_batch span includes the time the caller spends on each result.
+    with metrics.span('eia_batch'):
+        if len(urls) <= 1:
+            for url in urls:
+                yield url, get(url)
+            return
+        futures = {executor.submit(get, url): url for url in urls}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+@metrics.timed('series_parse')
+def series_frame(units, periods, values):
+    #(units, df) from decode.decode_series' arrays, df columns Year, Month, Value in date order.
+    #Month is 0 for annual series.
+    order = np.argsort(periods, kind = 'stable')
+    periods = periods[order]
+    df = pd.DataFrame({
+        'Year': periods // 100,
+        'Month': periods % 100,
+        'Value': values[order]})
+    return units, df
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key. The first caller for a key
+    runs the call; callers arriving while it is in flight wait for its result.
+
+    stats counts keys requested ('calls'), keys this process actually ran
+    ('fetches'), keys that waited on another caller's run ('coalesced') and
+    repeated keys collapsed within a single request ('deduplicated').
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.stats = {'calls': 0, 'fetches': 0, 'coalesced': 0, 'deduplicated': 0}
+
+    def do_many(self, keys, fn):
+        #fn(keys) is called with the keys this caller leads and returns {key: result}.
+        #Returns {key: result} for every key in keys.
+        leading = []
+        waiting = {}
+        with self.lock:
+            for key in keys:
+                self.stats['calls'] += 1
+                if key in waiting or key in leading:
+                    self.stats['deduplicated'] += 1
+                elif key in self.flights:
+                    self.stats['coalesced'] += 1
+                    waiting[key] = self.flights[key]
+                else:
+                    self.flights[key] = Future()
+                    leading.append(key)
+            self.stats['fetches'] += len(leading)
+
+        res = {}
+        if leading:
+            try:
+                res = fn(leading)
+            except BaseException as e:
+                self._land(leading, {}, e)
+                raise
+            self._land(leading, res, None)
+
+        for key, flight in waiting.items():
+            res[key] = flight.result()
+        return res
+
+    def do(self, key, fn):
+        return self.do_many([key], lambda keys: {key: fn()})[key]
+
+    def _land(self, keys, res, exc):
+        with self.lock:
+            landed = [self.flights.pop(key) for key in keys]
+        for key, flight in zip(keys, landed):
+            if exc is not None:
+                flight.set_exception(exc)
+            else:
+                flight.set_result(res.get(key))
+
+class Background:
+    """
+    Runs loads off the request path, on a small pool of threads of their own.
+    Each load has a key; starting a key that is already queued or running
+    does nothing. The exception a load raised is kept for failed() to report.
+
+    Both are per process: under gunicorn, a poll that lands on another
+    worker starts the load there too, and sees its failure only once its
+    own load fails. The duplicate load costs little, since each series it
+    finds stored by the first one isn't fetched again.
+
+    stats counts loads started, starts of a key already running
+    ('deduplicated') and loads that raised ('failed').
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.stats = {'started': 0, 'deduplicated': 0, 'failed': 0}
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers = self.workers, thread_name_prefix = 'eia-load')
+        self.running = set()
+        self.errors = {}
+
+    def start(self, key, fn):
+        with self.lock:
+            if key in self.running:
+                self.stats['deduplicated'] += 1
+                return
+            self.running.add(key)
+            self.errors.pop(key, None)
+            self.stats['started'] += 1
+        self.executor.submit(self._run, key, fn)
+
+    def failed(self, key):
+        #The exception the last load under key raised, or None. Reported once.
+        with self.lock:
+            return self.errors.pop(key, None)
+
+    def _run(self, key, fn):
+        try:
+            fn()
+        except Exception as e:
+            log.warning("background load %r failed: %s", key, e)
+            with self.lock:
+                self.errors[key] = e
+                self.stats['failed'] += 1
+        finally:
+            with self.lock:
+                self.running.discard(key)
+
+flights = SingleFlight()
+background = Background(int(os.environ.get('EIA_BACKGROUND_WORKERS', 4)))
+
+@metrics.collector
+def flight_metrics():
+    yield ('eia_fetch_keys_total', 'counter', "Series requested through single-flight, by outcome.",
+        [({'outcome': outcome}, n) for outcome, n in sorted(flights.stats.items())])
+    yield ('eia_background_loads_total', 'counter', "Background loads, by outcome.",
+        [({'outcome': outcome}, n) for outcome, n in sorted(background.stats.items())])
+    yield ('eia_fetch_retries_total', 'counter', "Failed EIA requests, by whether they were retried or given up on.",
+        [({'outcome': outcome}, n) for outcome, n in sorted(retries.items())])
+    yield ('eia_breaker_events_total', 'counter', "Circuit breaker events.",
+        [({'event': event}, n) for event, n in sorted(breaker.stats.items())])
+    state = breaker.state()
+    yield ('eia_breaker_state', 'gauge', "1 for the circuit breaker's current state.",
+        [({'state': name}, int(state == name)) for name in ['closed', 'half_open', 'open']])
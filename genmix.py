@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Generation-mix engine for the Con/Prod tab.
+
+Each state's net generation is held as one wide (month x fuel) float matrix.
+A view for a set of fuels and a year range is then one slice, one division
+by the ALL column and one cumulative sum, instead of a merge per fuel and a
+re-sum of every earlier column for each fuel. The stacking order can be
+taken from one year range and applied to another, so the plot can hold a
+state's whole history while showing a window of it.
+
+Values are held as float32 and periods as int32 to keep the cached matrices
+small; arithmetic on a view is done in float64.
+"""
+
+import numpy as np
+import pandas as pd
+
+class GenerationMix:
+
+    def __init__(self, periods, fuels, values):
+        #periods is a sorted int array of Year * 100 + Month, values is (len(periods), len(fuels)).
+        self.periods = np.asarray(periods, dtype = np.int32)
+        self.fuels = list(fuels)
+        self.columns = {fuel: i for i, fuel in enumerate(self.fuels)}
+        self.values = np.asarray(values, dtype = np.float32)
+
+    @property
+    def nbytes(self):
+        return self.periods.nbytes + self.values.nbytes
+
+    @classmethod
+    def from_frames(cls, frames):
+        #frames is {fuel: df} with df columns Year, Month, <fuel>, as returned by get_net_gen_batch.
+        return cls(np.empty(0, dtype = np.int32), [], np.empty((0, 0))).extend(frames)
+
+    def extend(self, frames):
+        #Returns a new GenerationMix with frames written in. Fuels it doesn't hold become new columns;
+        #observations for fuels it does hold are added, or replace the ones held for the same month.
+        fuels = self.fuels + [fuel for fuel in frames if fuel not in self.columns]
+        new_periods = {fuel: (df.Year * 100 + df.Month).to_numpy(dtype = np.int32) for fuel, df in frames.items()}
+        periods = np.unique(np.concatenate([self.periods] + list(new_periods.values())))
+
+        values = np.full((len(periods), len(fuels)), np.nan, dtype = np.float32)
+        values[np.searchsorted(periods, self.periods), :len(self.fuels)] = self.values
+        for fuel, df in frames.items():
+            values[np.searchsorted(periods, new_periods[fuel]), fuels.index(fuel)] = df[fuel].to_numpy(dtype = np.float32)
+
+        return GenerationMix(periods, fuels, values)
+
+    def cumulative(self, fuels, start = None, end = None, order = None):
+        #fuels must include "ALL". Returns the frame plot_net_gens draws: Year, Month, one column per fuel other than ALL
+        #holding the cumulative fraction of ALL, and xaxis_labels. Rows run from start to end, or over every month held
+        #if they are None, and fuels are stacked in the given order, or in order of increasing variance.
+        block, periods = self._block(fuels, start, end)
+        fraction_fuels = self._by_variance(block, fuels) if order is None else list(order)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            fractions = block[:, [fuels.index(fuel) for fuel in fraction_fuels]] / block[:, [fuels.index("ALL")]]
+        cumulative = np.nancumsum(fractions, axis = 1)
+
+        res = pd.DataFrame(cumulative, columns = fraction_fuels)
+        res.insert(0, 'Year', periods // 100)
+        res.insert(1, 'Month', periods % 100)
+        res['xaxis_labels'] = res.Month.astype(str) + "/" + res.Year.astype(str)
+        return res
+
+    def fractions(self, fuels, start = None, end = None):
+        #Year, Month and each fuel's fraction of ALL, one column per fuel other than ALL, from start to end.
+        block, periods = self._block(fuels, start, end)
+        fraction_fuels = [fuel for fuel in fuels if fuel != "ALL"]
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            fractions = block[:, [fuels.index(fuel) for fuel in fraction_fuels]] / block[:, [fuels.index("ALL")]]
+        res = pd.DataFrame(fractions, columns = fraction_fuels)
+        res.insert(0, 'Year', periods // 100)
+        res.insert(1, 'Month', periods % 100)
+        return res
+
+    def order(self, fuels, start = None, end = None):
+        #The fuels other than ALL in order of increasing variance from start to end, the order cumulative() stacks them in.
+        return self._by_variance(self._block(fuels, start, end)[0], fuels)
+
+    def months(self, fuels):
+        #Periods of the rows cumulative(fuels) returns when start and end are None.
+        return self._block(fuels, None, None)[1]
+
+    def _block(self, fuels, start, end):
+        #(values, periods) for fuels in months from start to end where at least one of them reported,
+        #as an outer merge of them would give.
+        years = self.periods // 100
+        rows = np.ones(len(years), dtype = bool)
+        if start is not None:
+            rows &= years >= start
+        if end is not None:
+            rows &= years <= end
+        block = self.values[np.ix_(rows, [self.columns[fuel] for fuel in fuels])].astype(np.float64)
+        has_data = ~np.isnan(block).all(axis = 1)
+        return block[has_data], self.periods[rows][has_data]
+
+    @staticmethod
+    def _by_variance(block, fuels):
+        #Sample variance of each column over the months it reported, sorted as DataFrame.var().sort_values() would,
+        #in numpy so that ordering a view doesn't build a frame. Columns with fewer than two values go last.
+        counts = (~np.isnan(block)).sum(axis = 0)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            deviations = block - np.nansum(block, axis = 0) / counts
+            variances = np.nansum(deviations * deviations, axis = 0) / (counts - 1)
+        known = np.flatnonzero(counts >= 2)
+        order = np.concatenate([known[np.argsort(variances[known])], np.flatnonzero(counts < 2)])
+        return [fuels[i] for i in order if fuels[i] != "ALL"]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""
+gunicorn settings, read from the working directory by `gunicorn app:server`.
+
+With EIA_PRELOAD on (the default) the app is imported once, in the master.
+Before forking, the master maps a snapshot of the store and builds every
+state's frames (see app.preload). Workers start with all of that and share
+its pages, instead of each importing pandas, Plotly and Dash and filling its
+own caches. EIA_PRELOAD=0 imports the app in each worker.
+
+The worker count comes from WEB_CONCURRENCY, which gunicorn reads itself.
+"""
+
+import gc
+import os
+
+preload_app = os.environ.get('EIA_PRELOAD', '1') not in ('', '0')
+
+def when_ready(server):
+    #Runs in the master once the app is loaded, before any worker is forked.
+    if not preload_app:
+        return
+    import app
+    states = app.preload()
+    server.log.info("preloaded %d states", len(states))
+    #Objects the workers inherit are moved out of the collector's reach, so collections in a worker
+    #don't write to (and so copy) the pages holding them.
+    gc.collect()
+    gc.freeze()
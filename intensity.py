@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Cross-state panel for the Intensity tab.
+
+Population, real GDP and total energy consumption for every state, with the
+derived perCap and perUSD ratios, in one long frame indexed by (state, Year).
+It is built from one bulk read of the stored SEDS series and one pivot, so
+plotting any set of states is a slice of the panel.
+"""
+
+#SEDS series codes and the panel columns they fill.
+CODES = {'TPOPP': 'population', 'GDPRX': 'real_gdp', 'TETCB': 'consumption'}
+
+def series_ids(states):
+    return ["SEDS." + code + "." + state + ".A" for state in states for code in CODES]
+
+def build_panel(long):
+    #long has columns series_id, Year, Value, one row per SEDS observation. States missing one of their series
+    #are left out, so a state is in the panel only once all of it has been loaded.
+    states = long.series_id.str.split('.').str[2]
+    complete = long.series_id.groupby(states).nunique()
+    return with_ratios(_pivot(long[states.isin(complete.index[complete == len(CODES)])]))
+
+def update_panel(panel, long):
+    #Returns panel with the observations in long written over it, and the ratios recomputed. Rows of states
+    #not in the panel are dropped, as they may not be complete.
+    update = _pivot(long)
+    update = update[update.index.get_level_values('state').isin(panel.index.unique('state'))]
+    return with_ratios(update.combine_first(panel.loc[:, list(CODES.values())]))
+
+def with_ratios(panel):
+    panel = panel.assign(
+        perCap = panel.consumption / panel.population,
+        perUSD = panel.consumption / panel.real_gdp)
+    return panel.astype('float32')
+
+def _pivot(long):
+    parts = long.series_id.str.split('.')
+    panel = long.assign(code = parts.str[1], state = parts.str[2]).pivot(index = ['state', 'Year'], columns = 'code', values = 'Value')
+    panel = panel.reindex(columns = list(CODES)).rename(columns = CODES)
+    panel.columns.name = None
+    return panel
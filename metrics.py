@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Hot-path timing and a Prometheus-style /metrics route.
+
+Code on the hot path wraps each stage in span(stage): the EIA request, JSON
+decoding, store reads and writes, the pandas work behind each plot, and
+Plotly figure building. Spans feed one histogram per stage. Modules that keep
+their own counters (the caches, single-flight) register a collector that
+renders them at scrape time.
+
+Metrics are per process; under gunicorn each scrape is answered by whichever
+worker takes it, so each sample carries a pid label.
+
+With EIA_PROFILE=1 every Dash callback request is run under cProfile, and
+its spans are sent back in a Server-Timing header. Profiles are written to
+EIA_PROFILE_DIR if it is set, and logged otherwise.
+"""
+
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+import flask
+
+PROFILE = os.environ.get('EIA_PROFILE', '') not in ('', '0')
+PROFILE_DIR = os.environ.get('EIA_PROFILE_DIR')
+
+BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+log = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_histograms = {}
+_local = threading.local()
+collectors = []
+
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+def timed(stage):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def observe(stage, seconds):
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = [[0] * len(BUCKETS), 0, 0.0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram[0][i] += 1
+        histogram[1] += 1
+        histogram[2] += seconds
+    request_spans = getattr(_local, 'spans', None)
+    if request_spans is not None:
+        request_spans[stage] = request_spans.get(stage, 0.0) + seconds
+
+def collector(fn):
+    #fn() returns an iterable of (name, type, help, [(labels, value)]) for render() to format.
+    collectors.append(fn)
+    return fn
+
+def render():
+    pid = str(os.getpid())
+    lines = [
+        "# HELP eia_stage_seconds Time spent in each hot-path stage.",
+        "# TYPE eia_stage_seconds histogram"]
+    with _lock:
+        histograms = {stage: (list(h[0]), h[1], h[2]) for stage, h in _histograms.items()}
+    for stage, (buckets, count, total) in sorted(histograms.items()):
+        labels = 'pid="' + pid + '",stage="' + stage + '"'
+        for bound, n in zip(BUCKETS, buckets):
+            lines.append('eia_stage_seconds_bucket{' + labels + ',le="' + str(bound) + '"} ' + str(n))
+        lines.append('eia_stage_seconds_bucket{' + labels + ',le="+Inf"} ' + str(count))
+        lines.append('eia_stage_seconds_sum{' + labels + '} ' + repr(total))
+        lines.append('eia_stage_seconds_count{' + labels + '} ' + str(count))
+
+    for fn in collectors:
+        for name, metric_type, help_text, samples in fn():
+            lines.append("# HELP " + name + " " + help_text)
+            lines.append("# TYPE " + name + " " + metric_type)
+            for labels, value in samples:
+                labels = dict(labels, pid = pid)
+                lines.append(name + '{' + ','.join(k + '="' + str(v) + '"' for k, v in sorted(labels.items())) + '} ' + str(value))
+    return '\n'.join(lines) + '\n'
+
+def init_app(server):
+    server.add_url_rule('/metrics', 'metrics', lambda: flask.Response(render(), mimetype = 'text/plain; version=0.0.4'))
+    if PROFILE:
+        server.before_request(_start_profile)
+        server.after_request(_finish_profile)
+
+def _start_profile():
+    if not flask.request.path.startswith('/_dash-update-component'):
+        return
+    _local.spans = {}
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        #Another profiler is already running in this process.
+        return
+    flask.g.profiler = profiler
+
+def _finish_profile(response):
+    request_spans = getattr(_local, 'spans', None)
+    _local.spans = None
+    profiler = flask.g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        name = time.strftime('%Y%m%d-%H%M%S') + '-' + str(os.getpid()) + '-' + str(threading.get_ident())
+        if PROFILE_DIR:
+            profiler.dump_stats(os.path.join(PROFILE_DIR, name + '.prof'))
+        else:
+            out = io.StringIO()
+            pstats.Stats(profiler, stream = out).sort_stats('cumulative').print_stats(25)
+            log.info("profile %s\n%s", name, out.getvalue())
+    if request_spans:
+        response.headers['Server-Timing'] = ', '.join(
+            stage + ';dur=' + '%.1f' % (seconds * 1000) for stage, seconds in request_spans.items())
+    return response
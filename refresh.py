@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental refresh of stored series.
+
+A background thread wakes every EIA_REFRESH_INTERVAL seconds and refreshes
+series that have not been refreshed for EIA_REFRESH_TTL seconds. Only
+observations after the last period stored are asked for, and only new rows
+are written. Workers claim series through the store, so each series is
+refreshed by one worker. User callbacks never wait on a refresh; they keep
+reading the store. Series whose refresh fails are released, to be tried
+again on the next pass rather than a whole TTL later; the rest of their
+batch is stored as usual.
+
+A fuel EIA has no series for in a state is stored as zeros on the dates of
+the state's ALL series, and marked zero-filled (see app.store_zero_net_gen).
+Its refresh doesn't ask EIA for it again: the zeros are extended over the
+new periods of the state's ALL series, which is fetched once per batch.
+
+Rollup series (see rollups.py) aren't asked of EIA. Their new periods are
+summed from the member series' new rows, and passed on with them.
+
+Functions registered with on_new_rows are called with {series_id: new rows}
+and the store's data_version from before the new rows were written, after
+each refresh, to fold the new rows into derived products.
+"""
+
+import logging
+import os
+import threading
+import time
+import fetch
+import rollups
+import store
+
+REFRESH_TTL = float(os.environ.get('EIA_REFRESH_TTL', 24 * 3600))
+REFRESH_INTERVAL = float(os.environ.get('EIA_REFRESH_INTERVAL', 600))
+REFRESH_BATCH = int(os.environ.get('EIA_REFRESH_BATCH', 100))
+
+log = logging.getLogger(__name__)
+
+listeners = []
+
+def on_new_rows(fn):
+    listeners.append(fn)
+    return fn
+
+def start_param(last_period):
+    #EIA's start= value for the period after last_period (Year * 100 + Month, Month 0 for annual series).
+    year, month = divmod(last_period, 100)
+    if month == 0:
+        return str(year + 1)
+    if month == 12:
+        return str(year + 1) + "01"
+    return str(year) + str(month + 1).zfill(2)
+
+def refresh_series(series_ids):
+    #Fetches and stores observations newer than what is stored for each series. Returns {series_id: new rows}.
+    #If EIA fails on some series, the others' rows are still stored and passed on; the failed series are released
+    #and the first error is raised.
+    periods = store.last_periods(series_ids)
+    series_ids = [series_id for series_id in series_ids if periods.get(series_id) is not None and not rollups.is_rollup(series_id)]
+    #Zero-filled fuels aren't asked of EIA, which has no series for them. Their states' ALL series are, once each,
+    #along with the batch unless they are already in it.
+    zero_filled = store.zero_filled(series_ids)
+    to_fetch = [series_id for series_id in series_ids if series_id not in zero_filled]
+    all_ids = [all_id for all_id in dict.fromkeys(rollups.all_gen_id(series_id) for series_id in zero_filled) if all_id not in to_fetch]
+    periods.update(store.last_periods(all_ids))
+    to_fetch += [all_id for all_id in all_ids if periods.get(all_id) is not None]
+    urls = [fetch.api_url + series_id + "&start=" + start_param(periods[series_id]) for series_id in to_fetch]
+
+    new_rows = {}
+    failed = set()
+    error = None
+    unknown = []
+    version = store.data_version()
+    #The batch's writes, rollups included, move data_version on once, before listeners fold them in.
+    with store.one_version():
+        for series_id, loaded in zip(to_fetch, fetch.fetch_many(urls, fetch.fetch_series_or_error)):
+            if isinstance(loaded, Exception):
+                failed.add(series_id)
+                error = error or loaded
+                continue
+            if loaded is None:
+                if rollups.is_fuel_gen(series_id):
+                    unknown.append(series_id)
+                continue
+            units, df = loaded
+            df = df[df.Year * 100 + df.Month > periods[series_id]].reset_index(drop = True)
+            if len(df):
+                store.write_series(series_id, units, df)
+                new_rows[series_id] = df
+        #A fuel stored before zero-filled series were marked is marked once EIA says it has no series, and extended from the next pass on.
+        store.mark_zero_filled(unknown)
+
+        #Zero-filled fuels get zeros on the periods the stored ALL series, now refreshed, has after theirs.
+        extend = [series_id for series_id in zero_filled if rollups.all_gen_id(series_id) not in failed]
+        if extend:
+            alls = store.read_long(list(dict.fromkeys(rollups.all_gen_id(series_id) for series_id in extend)), min(periods[series_id] for series_id in extend))
+            units = store.read_units(extend)
+            for series_id in extend:
+                df = alls[alls.series_id == rollups.all_gen_id(series_id)]
+                df = df.loc[df.Year * 100 + df.Month > periods[series_id], ['Year', 'Month']].reset_index(drop = True).assign(Value = 0.0)
+                if len(df):
+                    store.write_series(series_id, units[series_id], df, zero_filled = True)
+                    new_rows[series_id] = df
+        #An ALL series fetched only for zero-filled fuels wasn't claimed, so it is their refresh that failed.
+        failed = [series_id for series_id in series_ids if series_id in failed or (series_id in zero_filled and rollups.all_gen_id(series_id) in failed)]
+        if failed:
+            #EIA is down or too slow. The stored copies keep being served, and these series are retried first next time.
+            store.release(failed)
+        if new_rows:
+            new_rows.update(rollups.update(new_rows))
+
+    if new_rows:
+        for fn in listeners:
+            fn(new_rows, version)
+    if error is not None:
+        raise error
+    return new_rows
+
+def refresh_stale(ttl = REFRESH_TTL, limit = REFRESH_BATCH):
+    #Refreshes every series not refreshed for ttl seconds, limit at a time.
+    before = time.time() - ttl
+    new_rows = {}
+    while True:
+        series_ids = store.claim_stale(before, limit)
+        if not series_ids:
+            return new_rows
+        new_rows.update(refresh_series(series_ids))
+
+_started = {}
+
+def start():
+    #Starts this process's refresher thread, once. EIA_REFRESH_TTL=0 turns refreshing off.
+    if REFRESH_TTL <= 0 or _started.get(os.getpid()):
+        return
+    _started[os.getpid()] = True
+    threading.Thread(target = _run, name = 'eia-refresh', daemon = True).start()
+
+def _run():
+    while True:
+        time.sleep(REFRESH_INTERVAL)
+        try:
+            new_rows = refresh_stale()
+            if new_rows:
+                log.info("refreshed %d series", len(new_rows))
+        except Exception:
+            log.exception("refresh failed")
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Regional and national rollups of the state series.
+
+A rollup is a named group of states: the US, the four census regions, and
+the ISOs approximated by the states that lie mostly inside their footprint.
+For every series the app reads for a state there is a rollup series, with the
+group's code in place of the state's (ELEC.SALES.Midwest-ALL.M is the sum of
+the Midwest states' ELEC.SALES.<state>-ALL.M). Rollup series are computed
+from the stored member series with one groupby-sum and stored like any other
+series, so everything downstream (seasonal bands, generation matrices, the
+intensity panel, cached figures) treats a group as one more state.
+
+A period is only kept where every member has a value, so a month some states
+haven't reported yet doesn't show up as a dip. For a fuel's net generation,
+a member has the month if its ALL series does: a null or missing month of
+the fuel counts as zero, as does a fuel whose series starts late, so one
+state's gap doesn't blank the fuel for the whole group. When a refresh adds
+rows to member series, update() recomputes the rollups they feed from the
+earliest new period on.
+
+Set EIA_ROLLUPS to a JSON file of {code: {"label": ..., "states": [...]}} to
+use other groups. Codes must not contain '.' or '-', or clash with a state.
+"""
+
+import json
+import os
+import re
+import pandas as pd
+import store
+
+GROUPS = {
+    'US': {'label': "United States", 'states': ["AL", "AK", "AZ", "AR", "CA", "CO", "CT", "DE", "DC", "FL", "GA", "HI", "ID", "IL", "IN", "IA", "KS", "KY", "LA", "ME", "MD", "MA", "MI", "MN", "MS", "MO", "MT", "NE", "NV", "NH", "NJ", "NM", "NY", "NC", "ND", "OH", "OK", "OR", "PA", "RI", "SC", "SD", "TN", "TX", "UT", "VT", "VA", "WA", "WV", "WI", "WY"]},
+    'Northeast': {'label': "Northeast (census region)", 'states': ["CT", "ME", "MA", "NH", "RI", "VT", "NJ", "NY", "PA"]},
+    'Midwest': {'label': "Midwest (census region)", 'states': ["IL", "IN", "MI", "OH", "WI", "IA", "KS", "MN", "MO", "NE", "ND", "SD"]},
+    'South': {'label': "South (census region)", 'states': ["DE", "DC", "FL", "GA", "MD", "NC", "SC", "VA", "WV", "AL", "KY", "MS", "TN", "AR", "LA", "OK", "TX"]},
+    'West': {'label': "West (census region)", 'states': ["AZ", "CO", "ID", "MT", "NV", "NM", "UT", "WY", "AK", "CA", "HI", "OR", "WA"]},
+    'ISONE': {'label': "ISO New England", 'states': ["CT", "ME", "MA", "NH", "RI", "VT"]},
+    'PJM': {'label': "PJM (approx.)", 'states': ["DE", "DC", "MD", "NJ", "OH", "PA", "VA", "WV"]},
+    'MISO': {'label': "MISO (approx.)", 'states': ["AR", "IA", "LA", "MI", "MN", "MS", "ND", "WI"]},
+    'SPP': {'label': "SPP (approx.)", 'states': ["KS", "NE", "OK"]},
+}
+
+if os.environ.get('EIA_ROLLUPS'):
+    with open(os.environ['EIA_ROLLUPS']) as f:
+        GROUPS = json.load(f)
+
+#Groups each state belongs to.
+_member_of = {}
+for code, group in GROUPS.items():
+    for state in group['states']:
+        _member_of.setdefault(state, []).append(code)
+
+#(prefix, state, suffix) of a net generation, retail sales or SEDS series id.
+_series_id = re.compile(r'(ELEC\.GEN\.[^-]+-|ELEC\.SALES\.|SEDS\.[^.]+\.)([^.-]+)(.*)')
+
+def label(code):
+    #What the dropdowns show for a state or group code.
+    return GROUPS[code]['label'] if code in GROUPS else code
+
+def is_rollup(series_id):
+    match = _series_id.match(series_id)
+    return match is not None and match.group(2) in GROUPS
+
+def member_ids(series_id):
+    #The member series a rollup series sums.
+    prefix, code, suffix = _series_id.match(series_id).groups()
+    return [prefix + state + suffix for state in GROUPS[code]['states']]
+
+def rollup_ids(series_id):
+    #The rollup series a state series feeds.
+    match = _series_id.match(series_id)
+    if match is None:
+        return []
+    prefix, state, suffix = match.groups()
+    return [prefix + code + suffix for code in _member_of.get(state, [])]
+
+def state_of(series_id):
+    return _series_id.match(series_id).group(2)
+
+def is_fuel_gen(series_id):
+    #Whether series_id is one fuel's net generation, rather than ALL or another kind of series.
+    return series_id.startswith("ELEC.GEN.") and not series_id.startswith("ELEC.GEN.ALL-")
+
+def all_gen_id(series_id):
+    #The ALL net generation series of the state or group of a fuel's net generation series.
+    return "ELEC.GEN.ALL-" + series_id.split('-', 1)[1]
+
+def coverage_ids(series_id):
+    #The member series whose periods a rollup series has a value for: its members, and for a fuel their ALL series.
+    members = member_ids(series_id)
+    return members + member_ids(all_gen_id(series_id)) if is_fuel_gen(series_id) else members
+
+def compute(series_ids, since = None):
+    #{rollup series_id: df} with df columns Year, Month, Value in date order, summed from the stored member series,
+    #for the periods (from since on, if given) every member has a value. All rollups are summed in one pass.
+    #A fuel's members' ALL series take part with their values zeroed, so a member with the month in ALL counts as reporting it.
+    rows = []
+    for series_id in series_ids:
+        members = member_ids(series_id)
+        rows += [(member, series_id, state_of(member), True, len(members)) for member in members]
+        if is_fuel_gen(series_id):
+            rows += [(member, series_id, state_of(member), False, len(members)) for member in member_ids(all_gen_id(series_id))]
+    membership = pd.DataFrame(rows, columns = ['series_id', 'rollup', 'state', 'summed', 'members'])
+    long = store.read_long(list(membership.series_id.unique()), since)
+    long = long[long.Value.notna()].merge(membership, on = 'series_id')
+    long['Value'] = long.Value.where(long.summed, 0.0)
+    by_member = long.groupby(['rollup', 'Year', 'Month', 'state']).agg(Value = ('Value', 'sum'), members = ('members', 'first'))
+    sums = by_member.groupby(['rollup', 'Year', 'Month']).agg(Value = ('Value', 'sum'), n = ('Value', 'size'), members = ('members', 'first'))
+    sums = sums[sums.n == sums.members].reset_index()
+    return {series_id: df.loc[:, ['Year', 'Month', 'Value']].reset_index(drop = True)
+        for series_id, df in sums.groupby('rollup') if len(df)}
+
+def materialize(series_ids):
+    #Computes and stores the rollup series_ids. Returns {series_id: (units, df)} for those with any complete period.
+    computed = compute(series_ids)
+    units = store.read_units([member_ids(series_id)[0] for series_id in computed])
+    res = {}
+    for series_id, df in computed.items():
+        res[series_id] = (units.get(member_ids(series_id)[0]), df)
+        store.write_series(series_id, *res[series_id])
+    return res
+
+def update(new_rows):
+    #new_rows is {series_id: rows just added} for state series. Recomputes the stored rollups they feed from the
+    #earliest new period on, stores the periods that are new, and returns them as {rollup series_id: rows}.
+    since = {}
+    for series_id, df in new_rows.items():
+        first = int((df.Year * 100 + df.Month).min())
+        for rollup_id in rollup_ids(series_id):
+            since[rollup_id] = min(since.get(rollup_id, first), first)
+    #Rollups nobody has asked for yet are left to be materialized when they are.
+    last = store.last_periods(list(since))
+    if not last:
+        return {}
+    units = store.read_units(list(last))
+    res = {}
+    for series_id, df in compute(list(last), min(since[series_id] for series_id in last)).items():
+        df = df[df.Year * 100 + df.Month > last[series_id]].reset_index(drop = True)
+        if len(df):
+            store.write_series(series_id, units[series_id], df)
+            res[series_id] = df
+    return res
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+Seasonal band index for the consumption plot.
+
+For every state and calendar month the index holds the Min, Q1, Q3 and Max
+of retail sales (TWh) over the whole history of that month. It is built in
+one groupby pass over all states and kept in the store. When new months
+arrive only the (state, month) groups they fall in are recomputed.
+"""
+
+import pandas as pd
+
+def compute_bands(sales):
+    #sales is a long frame with columns state, Month, TWh. Returns bands indexed by (state, Month).
+    grouped = sales.groupby(['state', 'Month'])['TWh']
+    return pd.DataFrame({
+        'Min': grouped.min(),
+        'Q1': grouped.quantile(0.25),
+        'Q3': grouped.quantile(0.75),
+        'Max': grouped.max()})
+
+def update_bands(sales, new_rows):
+    #Recomputes only the groups new_rows (columns state, Month) fall in, from the full history in sales.
+    touched = pd.MultiIndex.from_frame(new_rows.loc[:, ['state', 'Month']].drop_duplicates())
+    in_touched = pd.MultiIndex.from_frame(sales.loc[:, ['state', 'Month']]).isin(touched)
+    return compute_bands(sales[in_touched])
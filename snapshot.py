@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Read-only, memory-mapped snapshot of the store.
+
+Every stored observation is written out as flat Year, Month and Value
+arrays, one .npy file each, sorted by series and date, with the offset where
+each series' rows start. load() maps the files read-only, so every process
+that loads a snapshot, and every worker forked from a master that loaded it,
+shares one copy of its pages through the page cache. A series read from it
+is a slice of those arrays, not a copy.
+
+A series is only read from the snapshot while its last stored period is
+the one the snapshot was taken at; once a refresh adds rows to it, its reads
+go to the store, and every other series keeps being read from the snapshot.
+(Refreshes only ever add periods after the last one stored.)
+"""
+
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import store
+
+SNAPSHOT_DIR = os.environ.get('EIA_SNAPSHOT_DIR', store.STORE_PATH + '.snapshot')
+
+COLUMNS = ['Year', 'Month', 'Value']
+
+class Snapshot:
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'index.json')) as f:
+            index = json.load(f)
+        self.data_version = index['data_version']
+        self.units = index['units']
+        self.last_periods = index.get('last_periods')
+        self.rows = {series_id: i for i, series_id in enumerate(index['series_ids'])}
+        self.starts = np.load(os.path.join(path, 'starts.npy'))
+        self.columns = {column: np.load(os.path.join(path, column + '.npy'), mmap_mode = 'r') for column in COLUMNS}
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in self.columns.values())
+
+    def read_series(self, series_id):
+        #(units, df) as store.read_series returns them, or None if the snapshot doesn't hold the series.
+        i = self.rows.get(series_id)
+        if i is None:
+            return None
+        rows = slice(self.starts[i], self.starts[i + 1])
+        return self.units[i], pd.DataFrame({column: values[rows] for column, values in self.columns.items()}, copy = False)
+
+current = None
+
+def write(path = SNAPSHOT_DIR):
+    #Takes a snapshot of everything in the store. It replaces any snapshot at path as a whole; processes
+    #that have the old one mapped keep reading it.
+    version, series, observations = store.read_all()
+    codes = pd.Categorical(observations.series_id, categories = series.series_id).codes
+    tmp = path + '.tmp' + str(os.getpid())
+    os.makedirs(tmp)
+    with open(os.path.join(tmp, 'index.json'), 'w') as f:
+        json.dump({'data_version': version, 'series_ids': series.series_id.tolist(), 'units': series.units.tolist(),
+            'last_periods': [None if pd.isna(period) else int(period) for period in series.last_period]}, f)
+    np.save(os.path.join(tmp, 'starts.npy'), np.searchsorted(codes, np.arange(len(series) + 1)))
+    for column in COLUMNS:
+        np.save(os.path.join(tmp, column + '.npy'), observations[column].to_numpy())
+
+    old = path + '.old' + str(os.getpid())
+    if os.path.exists(path):
+        os.rename(path, old)
+    os.rename(tmp, path)
+    shutil.rmtree(old, ignore_errors = True)
+
+def load(path = SNAPSHOT_DIR):
+    #Maps the snapshot at path for read_series. Returns it, or None if there is none.
+    global current
+    if os.path.exists(os.path.join(path, 'index.json')):
+        snap = Snapshot(path)
+        #A snapshot taken before each series' last period was recorded can't be checked against the store.
+        if snap.last_periods is not None:
+            current = snap
+    return current
+
+def read_series(series_id):
+    #(units, df) from the loaded snapshot, or None if there is none, it doesn't hold the series or the series has
+    #rows the snapshot hasn't.
+    snap = current
+    i = snap.rows.get(series_id) if snap is not None else None
+    if i is None or snap.last_periods[i] != store.last_periods([series_id]).get(series_id):
+        return None
+    return snap.read_series(series_id)
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Local on-disk store for series pulled from the EIA API.
+
+Every observation is kept in one SQLite file, so all gunicorn workers share
+the same copy and nothing is lost when the dyno restarts. Values come back as
+typed columns (Year, Month, Value); nothing is re-parsed from JSON.
+
+data_version() goes up whenever a series already in the store changes, so
+anything derived from stored series (e.g. cached figures) can tell it is
+stale, in any worker. Adding a new series does not change it, nor does
+writing rows a series already holds. Writes made inside one_version() raise
+it once between them, e.g. for a whole refresh batch.
+
+The same file holds the seasonal band index (see seasonal.py), one row of
+Min/Q1/Q3/Max retail sales per state and calendar month.
+"""
+
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+import pandas as pd
+import metrics
+
+STORE_PATH = os.environ.get('EIA_STORE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'eia_store.sqlite'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (
+    series_id TEXT PRIMARY KEY,
+    units TEXT,
+    last_period INTEGER,
+    updated REAL,
+    zero_filled INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS observations (
+    series_id TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    value REAL,
+    PRIMARY KEY (series_id, year, month)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER
+);
+INSERT OR IGNORE INTO meta VALUES ('data_version', 0);
+CREATE TABLE IF NOT EXISTS seasonal_bands (
+    state TEXT NOT NULL,
+    month INTEGER NOT NULL,
+    min REAL,
+    q1 REAL,
+    q3 REAL,
+    max REAL,
+    PRIMARY KEY (state, month)
+) WITHOUT ROWID;
+"""
+
+#One connection per thread, reopened after a fork so workers never share a handle.
+_local = threading.local()
+
+def connect():
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.pid != os.getpid():
+        conn = sqlite3.connect(STORE_PATH, timeout = 30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(SCHEMA)
+        if 'zero_filled' not in [column[1] for column in conn.execute('PRAGMA table_info(series)')]:
+            #Stores written before series were marked zero-filled.
+            conn.execute('ALTER TABLE series ADD COLUMN zero_filled INTEGER NOT NULL DEFAULT 0')
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+@metrics.timed('store_read')
+def read_series(series_id):
+    #Returns (units, df) with df columns Year, Month, Value, or None if the series isn't stored.
+    conn = connect()
+    row = conn.execute('SELECT units FROM series WHERE series_id = ?', (series_id,)).fetchone()
+    if row is None:
+        return None
+    df = pd.read_sql_query(
+        'SELECT year AS Year, month AS Month, value AS Value FROM observations WHERE series_id = ? ORDER BY year, month',
+        conn,
+        params = (series_id,),
+        dtype = {'Year': 'int64', 'Month': 'int64', 'Value': 'float64'})
+    return row[0], df
+
+@contextlib.contextmanager
+def one_version():
+    #Writes from this thread inside the block raise data_version once, when it ends, if any of them changed a stored series.
+    if getattr(_local, 'deferred', None) is not None:
+        yield
+        return
+    _local.deferred = False
+    try:
+        yield
+    finally:
+        changed = _local.deferred
+        _local.deferred = None
+        if changed:
+            conn = connect()
+            with conn:
+                conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'data_version'")
+
+@metrics.timed('store_write')
+def write_series(series_id, units, df, zero_filled = False):
+    #df has columns Year, Month, Value. Month is 0 for annual series; NaN values are stored as NULL.
+    #Rows are merged into whatever is already stored for the series. zero_filled marks a series of zeros
+    #stored in place of one EIA has none for (see zero_filled()).
+    rows = zip([series_id] * len(df),
+        df.Year.astype(int).tolist(),
+        df.Month.astype(int).tolist(),
+        df.Value.astype(float).tolist())
+    last_period = int((df.Year * 100 + df.Month).max()) if len(df) else None
+    conn = connect()
+    with conn:
+        existing = conn.execute('SELECT units, last_period FROM series WHERE series_id = ?', (series_id,)).fetchone()
+        if existing is not None and existing[1] is not None:
+            last_period = existing[1] if last_period is None else max(existing[1], last_period)
+        #Rows identical to the stored ones aren't written, so rewriting a series another worker just stored,
+        #or one re-derived from unchanged inputs, counts no changes and leaves data_version alone.
+        changes = conn.total_changes
+        conn.executemany('INSERT INTO observations VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (series_id, year, month) DO UPDATE SET value = excluded.value WHERE value IS NOT excluded.value', rows)
+        if existing is not None and (conn.total_changes > changes or existing[0] != units):
+            if getattr(_local, 'deferred', None) is None:
+                conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'data_version'")
+            else:
+                _local.deferred = True
+        conn.execute('INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?, ?)',
+            (series_id, units, last_period, time.time(), int(zero_filled)))
+
+def data_version():
+    return connect().execute("SELECT value FROM meta WHERE key = 'data_version'").fetchone()[0]
+
+def read_bands(state):
+    #Returns the state's bands indexed by Month with columns Min, Q1, Q3, Max, or None if it isn't indexed.
+    df = pd.read_sql_query(
+        'SELECT month AS Month, min AS Min, q1 AS Q1, q3 AS Q3, max AS Max FROM seasonal_bands WHERE state = ? ORDER BY month',
+        connect(),
+        params = (state,),
+        index_col = 'Month')
+    if df.empty:
+        return None
+    return df.astype('float64')
+
+def write_bands(bands):
+    #bands is indexed by (state, Month) with columns Min, Q1, Q3, Max. Rows replace any already stored.
+    rows = zip(bands.index.get_level_values(0).tolist(),
+        bands.index.get_level_values(1).astype(int).tolist(),
+        bands.Min.tolist(), bands.Q1.tolist(), bands.Q3.tolist(), bands.Max.tolist())
+    conn = connect()
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO seasonal_bands VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+def last_periods(series_ids):
+    #{series_id: Year * 100 + Month of the latest stored observation} for the ids that are stored.
+    conn = connect()
+    res = {}
+    for series_id in series_ids:
+        row = conn.execute('SELECT last_period FROM series WHERE series_id = ?', (series_id,)).fetchone()
+        if row is not None:
+            res[series_id] = row[0]
+    return res
+
+def zero_filled(series_ids):
+    #The ids among series_ids stored as zeros because EIA has no such series.
+    conn = connect()
+    res = set()
+    for series_id in series_ids:
+        row = conn.execute('SELECT zero_filled FROM series WHERE series_id = ?', (series_id,)).fetchone()
+        if row is not None and row[0]:
+            res.add(series_id)
+    return res
+
+def mark_zero_filled(series_ids):
+    conn = connect()
+    with conn:
+        conn.executemany('UPDATE series SET zero_filled = 1 WHERE series_id = ?', [(series_id,) for series_id in series_ids])
+
+def claim_stale(before, limit):
+    #Marks up to limit series last updated before the timestamp before as updated now, and returns their ids.
+    #The claim is one write transaction, so concurrent workers never claim the same series.
+    now = time.time()
+    conn = connect()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        series_ids = [row[0] for row in conn.execute(
+            'SELECT series_id FROM series WHERE updated < ? ORDER BY updated LIMIT ?', (before, limit))]
+        conn.executemany('UPDATE series SET updated = ? WHERE series_id = ?', [(now, series_id) for series_id in series_ids])
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return series_ids
+
+def release(series_ids):
+    #Undoes claim_stale for series_ids, making them the first claimed next time.
+    conn = connect()
+    with conn:
+        conn.executemany('UPDATE series SET updated = 0 WHERE series_id = ?', [(series_id,) for series_id in series_ids])
+
+@metrics.timed('store_read')
+def read_long(series_ids, since = None):
+    #Every stored observation of series_ids in one query, as a long frame with columns series_id, Year, Month, Value.
+    #With since (Year * 100 + Month), only observations from that period on.
+    return pd.read_sql_query(
+        'SELECT series_id, year AS Year, month AS Month, value AS Value FROM observations WHERE series_id IN ('
+            + ','.join('?' * len(series_ids)) + ')' + (' AND year * 100 + month >= ?' if since is not None else '')
+            + ' ORDER BY series_id, year, month',
+        connect(),
+        params = list(series_ids) + ([int(since)] if since is not None else []),
+        dtype = {'Year': 'int64', 'Month': 'int64', 'Value': 'float64'})
+
+def read_units(series_ids):
+    #{series_id: units} for the ids that are stored.
+    conn = connect()
+    res = {}
+    for series_id in series_ids:
+        row = conn.execute('SELECT units FROM series WHERE series_id = ?', (series_id,)).fetchone()
+        if row is not None:
+            res[series_id] = row[0]
+    return res
+
+def checkpoint():
+    #Folds the write-ahead log into the main file, e.g. before the store is shipped in a build.
+    connect().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+def read_all():
+    #(data_version, series, observations) for everything stored, read in one transaction. series has columns
+    #series_id, units and last_period ordered by series_id; observations has columns series_id, Year, Month and Value,
+    #ordered by series_id and date.
+    conn = connect()
+    conn.execute('BEGIN')
+    try:
+        version = data_version()
+        series = pd.read_sql_query('SELECT series_id, units, last_period FROM series ORDER BY series_id', conn)
+        observations = pd.read_sql_query(
+            'SELECT series_id, year AS Year, month AS Month, value AS Value FROM observations ORDER BY series_id, year, month',
+            conn,
+            dtype = {'Year': 'int64', 'Month': 'int64', 'Value': 'float64'})
+    finally:
+        conn.rollback()
+    return version, series, observations
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Fills the store ahead of traffic.
+
+Loads every series the app can show into the store: net generation for each
+state and fuel, retail sales, and the SEDS series behind the Intensity tab.
+It then sums the regional and national rollups (see rollups.py) from the
+stored state series, builds the seasonal index and writes the store's
+snapshot (see snapshot.py), so the first visitor after a deploy reads from the store
+instead of waiting on EIA.
+
+Series can be ingested from local copies of EIA's bulk download files
+(ELEC.zip and SEDS.zip from https://www.eia.gov/opendata/bulkfiles.php, or
+the .txt inside them). These are read one line, i.e. one series, at a time,
+and only the series wanted are decoded, so memory stays flat however large
+the file. Anything the files don't hold is fetched from the API unless
+--no-api is given.
+
+    python warmup.py [--no-api] [--states NY CA ...] [ELEC.zip SEDS.zip ...]
+
+Heroku runs it at build time from bin/post_compile, so the filled store is
+part of the slug and every worker starts warm.
+"""
+
+import argparse
+import re
+import time
+import zipfile
+import urllib3
+import app
+import decode
+import fetch
+import rollups
+import snapshot
+import store
+
+_series_id = re.compile(rb'"series_id"\s*:\s*"([^"]*)"')
+
+def bulk_lines(path):
+    #Lines of a bulk file, or of every .txt in a bulk .zip, one at a time.
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for name in archive.namelist():
+                if name.endswith('.txt'):
+                    with archive.open(name) as f:
+                        yield from f
+    else:
+        with open(path, 'rb') as f:
+            yield from f
+
+def ingest_bulk(path, wanted):
+    #Stores the series of a bulk file whose ids are in the set wanted. Returns the ids stored.
+    res = set()
+    for line in bulk_lines(path):
+        #Only lines for wanted series are decoded; the id comes first in each line.
+        match = _series_id.search(line)
+        if match is None or match.group(1).decode() not in wanted:
+            continue
+        decoded = decode.decode_bulk_line(line)
+        if decoded is None:
+            continue
+        series_id, units, periods, values = decoded
+        store.write_series(series_id, *fetch.series_frame(units, periods, values))
+        res.add(series_id)
+    return res
+
+def warm(states, bulk_files = (), use_api = True):
+    wanted = app.all_series_ids(states)
+    for path in bulk_files:
+        start = time.time()
+        ingested = ingest_bulk(path, set(wanted))
+        print("%s: %d series in %.1f s" % (path, len(ingested), time.time() - start))
+
+    stored = store.last_periods(wanted)
+    missing = [series_id for series_id in wanted if series_id not in stored]
+    #Series EIA failed on, rather than answered it has no series for.
+    unanswered = set()
+    if use_api and missing:
+        start = time.time()
+        try:
+            found = app.get_series_batch(missing)
+            print("API: %d of %d series in %.1f s" % (len(found), len(missing), time.time() - start))
+        except urllib3.exceptions.HTTPError as e:
+            #What did arrive is stored and the warmup carries on. The rest is listed below, and loaded on demand
+            #once the app runs; fuels among it aren't zero-filled, as EIA may have a series for them.
+            stored = store.last_periods(wanted)
+            unanswered = set(series_id for series_id in missing if series_id not in stored)
+            print("API: %d of %d series in %.1f s, then: %s" % (len(missing) - len(unanswered), len(missing), time.time() - start, e))
+        stored = store.last_periods(wanted)
+
+    #Fuels with no series for a state get the zero series get_net_gen_batch would store for them.
+    zero_filled = 0
+    for state in states:
+        all_id = app.net_gen_id(state, "ALL")
+        if all_id not in stored:
+            continue
+        all_gen = None
+        for fuel in app.fuel_types:
+            series_id = app.net_gen_id(state, fuel)
+            if series_id not in stored and series_id not in unanswered:
+                all_gen = all_gen or store.read_series(all_id)
+                app.store_zero_net_gen(series_id, all_gen)
+                zero_filled += 1
+    #Only groups whose members were all warmed have complete periods to store.
+    summed = rollups.materialize(app.all_series_ids(list(rollups.GROUPS)))
+    stored = store.last_periods(wanted)
+
+    places = states + list(rollups.GROUPS)
+    sales = store.last_periods([app.retail_sales_id(state) for state in places])
+    indexed = [state for state in places if app.retail_sales_id(state) in sales]
+    if indexed:
+        app.build_seasonal_index(indexed)
+    store.checkpoint()
+    snapshot.write()
+
+    print("%d of %d series stored (%d zero-filled fuels), %d rollup series, seasonal index for %d states and groups, in %s" % (
+        len(stored), len(wanted), zero_filled, len(summed), len(indexed), store.STORE_PATH))
+    return [series_id for series_id in wanted if series_id not in stored]
+
+def main():
+    parser = argparse.ArgumentParser(description = "Load every series the app shows into the store.")
+    parser.add_argument('bulk_files', nargs = '*', metavar = 'FILE', help = "EIA bulk download file (.zip or .txt) to ingest")
+    parser.add_argument('--no-api', action = 'store_true', help = "don't fetch series the bulk files lack from the API")
+    parser.add_argument('--states', nargs = '+', default = app.states)
+    args = parser.parse_args()
+
+    missing = warm(args.states, args.bulk_files, use_api = not args.no_api)
+    if missing:
+        print("not stored: " + " ".join(missing[:20]) + (" ..." if len(missing) > 20 else ""))
+
+if __name__ == '__main__':
+    main()